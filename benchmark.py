@@ -0,0 +1,218 @@
+from argparse import ArgumentParser
+from time import perf_counter
+from tracemalloc import start, stop, get_traced_memory
+from math import sqrt, pi
+from numpy import stack, zeros, array_equal, asarray, floor, concatenate, cumsum, int64
+from numpy.random import default_rng
+from open3d import geometry, utility
+from scipy.ndimage import binary_fill_holes
+import rasterize_mesh
+from rasterize_mesh import rasterize_single_mesh, rasterize_tiny_meshes, fill_slices, ENGINES
+from solid_voxelizer import mark_surface
+
+
+# flat box whose surface voxelizes to roughly n_voxels voxels
+def make_plate(n_voxels: int):
+    side = max(int(sqrt(n_voxels / 2)), 2)
+    return geometry.TriangleMesh.create_box(width=side, height=side, depth=1)
+
+
+# sphere whose solid voxelizes to roughly n_voxels voxels, with its vertices snapped to the voxel grid as quantize does
+def make_sphere(n_voxels: int):
+    radius = max((3 * n_voxels / (4 * pi)) ** (1 / 3), 1)
+    mesh = geometry.TriangleMesh.create_sphere(radius, resolution=max(int(radius), 10))
+    return asarray(mesh.triangles, dtype=int64), floor(asarray(mesh.vertices)).astype(int64)
+
+
+# thin tube of roughly n_voxels voxels, 40 times longer than its radius, lying diagonally so most of its bounding box
+# is empty.  Its triangles are about a voxel across, as in surfaces exported from Imaris.
+def make_tube(n_voxels: int):
+    radius = max((n_voxels / (40 * pi)) ** (1 / 3), 1)
+    mesh = geometry.TriangleMesh.create_cylinder(radius, 40 * radius, resolution=max(int(2 * pi * radius), 10),
+                                                 split=max(int(40 * radius), 1))
+    mesh.rotate(mesh.get_rotation_matrix_from_xyz((pi / 4, pi / 4, 0)), center=(0, 0, 0))
+    mesh.vertices = utility.Vector3dVector(floor(asarray(mesh.vertices)))
+    return mesh
+
+
+# n_meshes plaques, spheres of 0.5 to 3 voxels radius at random positions, with their vertices snapped to the voxel
+# grid as quantize does.  Returns the faces of all plaques in one array, indexing the vertices of all plaques, and the
+# offset of each plaque's faces.
+def make_plaques(n_meshes: int, seed: int = 0):
+    rng = default_rng(seed)
+    faces = []
+    vertices = []
+    n_vertices = 0
+    for radius in rng.uniform(0.5, 3, n_meshes):
+        mesh = geometry.TriangleMesh.create_sphere(radius, resolution=10)
+        mesh_vertices = floor(asarray(mesh.vertices) + rng.uniform(0, 1000, 3))
+        faces.append(asarray(mesh.triangles, dtype=int64) + n_vertices)
+        vertices.append(mesh_vertices)
+        n_vertices += len(mesh_vertices)
+    face_offsets = zeros(n_meshes + 1, dtype=int64)
+    face_offsets[1:] = cumsum([len(mesh_faces) for mesh_faces in faces])
+    return concatenate(faces), face_offsets, concatenate(vertices)
+
+
+def timed(function, *args):
+    start = perf_counter()
+    result = function(*args)
+    return result, perf_counter() - start
+
+
+# readback of earlier versions: one python object per voxel and one assignment per voxel
+def loop_readback(voxel_grid, shape):
+    voxel_indices = stack([voxel.grid_index for voxel in voxel_grid.get_voxels()])
+    image = zeros(shape, dtype=bool)
+    for index in voxel_indices:
+        image[index[0], index[1], index[2]] = True
+    return image
+
+
+# the surface marked straight into the mask, as rasterize_single_mesh does, without an open3d voxel grid
+def bulk_readback(mesh, shape):
+    image = zeros(shape, dtype=bool)
+    mark_surface(asarray(mesh.vertices) - mesh.get_min_bound(), asarray(mesh.triangles, dtype=int64), image)
+    return image
+
+
+# the loop readback is only timed up to loop_limit voxels, as it needs several GB per 10^7 voxels
+def benchmark_readback(sizes: list, loop_limit: int):
+    print(f"{'voxels':>10} {'loop (s)':>10} {'bulk (s)':>10} {'speedup':>8}")
+    for n_voxels in sizes:
+        mesh = make_plate(n_voxels)
+        voxel_grid = geometry.VoxelGrid.create_from_triangle_mesh(mesh, voxel_size=1)
+        shape = tuple(int(extent) + 1 for extent in mesh.get_max_bound() - mesh.get_min_bound())
+        bulk_image, bulk_time = timed(bulk_readback, mesh, shape)
+        if n_voxels > loop_limit:
+            print(f"{int(bulk_image.sum()):>10} {'-':>10} {bulk_time:>10.4f} {'-':>8}")
+            continue
+        loop_image, loop_time = timed(loop_readback, voxel_grid, shape)
+        if not array_equal(loop_image, bulk_image):
+            print(f"ERROR: readbacks differ for {n_voxels} voxels.")
+            return -1
+        print(f"{int(bulk_image.sum()):>10} {loop_time:>10.4f} {bulk_time:>10.4f} {loop_time / bulk_time:>7.1f}x")
+    return 0
+
+
+# small spheres are rasterized through each engine's full path rather than the shared path for tiny meshes, which
+# would otherwise be timed for both engines
+def benchmark_engine(sizes: list):
+    tiny_mesh_voxels = rasterize_mesh.TINY_MESH_VOXELS
+    rasterize_mesh.TINY_MESH_VOXELS = 0
+    try:
+        # compile the native engine before timing it
+        rasterize_single_mesh(*make_sphere(10), 0, engine="native")
+
+        print(f"{'voxels':>10} " + " ".join(f"{engine + ' (s)':>12}" for engine in ENGINES)
+              + f" {'speedup':>8} {'IoU':>8}")
+        for n_voxels in sizes:
+            faces, vertices = make_sphere(n_voxels)
+            images = []
+            times = []
+            for engine in ENGINES:
+                (image, mins, maxs), elapsed = timed(rasterize_single_mesh, faces, vertices, 0, engine)
+                images.append(image)
+                times.append(elapsed)
+            if images[0].shape != images[1].shape:
+                print(f"ERROR: engines give different shapes for {n_voxels} voxels.")
+                return -1
+            iou = (images[0] & images[1]).sum() / max((images[0] | images[1]).sum(), 1)
+            print(f"{int(images[0].sum()):>10} " + " ".join(f"{elapsed:>12.4f}" for elapsed in times)
+                  + f" {times[0] / times[1]:>7.1f}x {iou:>8.4f}")
+    finally:
+        rasterize_mesh.TINY_MESH_VOXELS = tiny_mesh_voxels
+    return 0
+
+
+# rasterizes the plaques of make_plaques one at a time through the full rasterize_single_mesh path, and all at once
+# through rasterize_tiny_meshes
+def benchmark_tiny(n_meshes: int):
+    faces, face_offsets, vertices = make_plaques(n_meshes)
+    mesh_faces = [faces[face_offsets[m]:face_offsets[m + 1]] for m in range(n_meshes)]
+    corners = [vertices[mesh.ravel()] for mesh in mesh_faces]
+    mins = asarray([corner.min(axis=0) for corner in corners])
+    maxs = asarray([corner.max(axis=0) for corner in corners])
+    print(f"{n_meshes} plaques, {int((maxs - mins + 1).prod(axis=1).mean())} voxels per bounding box on average")
+
+    print(f"{'engine':>8} {'fill':>6} {'full (s)':>10} {'batch (s)':>10} {'speedup':>8} {'same':>6}")
+    tiny_mesh_voxels = rasterize_mesh.TINY_MESH_VOXELS
+    for engine, fill in [("open3d", "3d"), ("open3d", "slice"), ("native", "3d")]:
+        # compile the batch path before timing it
+        rasterize_tiny_meshes(faces, face_offsets[:2], vertices, mins[:1], maxs[:1], engine, fill)
+        batch, batch_time = timed(rasterize_tiny_meshes, faces, face_offsets, vertices, mins, maxs, engine, fill)
+        rasterize_mesh.TINY_MESH_VOXELS = 0
+        try:
+            start_time = perf_counter()
+            full = [rasterize_single_mesh(mesh, vertices, 0, engine, fill)[0] for mesh in mesh_faces]
+            full_time = perf_counter() - start_time
+        finally:
+            rasterize_mesh.TINY_MESH_VOXELS = tiny_mesh_voxels
+        same = all(array_equal(a, b) for a, b in zip(full, batch))
+        print(f"{engine:>8} {fill:>6} {full_time:>10.4f} {batch_time:>10.4f} {full_time / batch_time:>7.1f}x "
+              f"{str(same):>6}")
+        if not same:
+            print(f"ERROR: masks of the {engine} engine with the {fill} fill differ between the paths.")
+            return -1
+    return 0
+
+
+# time and peak memory allocated by function, which fills image in place or returns the filled image
+def timed_fill(function, image):
+    start()
+    filled, elapsed = timed(function, image)
+    peak = get_traced_memory()[1]
+    stop()
+    return filled, elapsed, peak
+
+
+# the 3d fill is only timed for bounding boxes of up to box_limit voxels, as it needs about 4 bytes per voxel
+def benchmark_fill(sizes: list, box_limit: int):
+    print(f"{'voxels':>10} {'box':>10} {'3d (s)':>10} {'slice (s)':>10} {'3d (MB)':>10} {'slice (MB)':>10} {'IoU':>8}")
+    for n_voxels in sizes:
+        # open3d checks every voxel of the bounding box when voxelizing, so the shell is marked natively instead
+        mesh = make_tube(n_voxels)
+        vertices = asarray(mesh.vertices) - mesh.get_min_bound()
+        shell = zeros(tuple(int(extent) + 1 for extent in vertices.max(axis=0)), dtype=bool)
+        mark_surface(vertices, asarray(mesh.triangles, dtype=int64), shell)
+        if shell.size > box_limit:
+            filled_slice, time_slice, peak_slice = timed_fill(fill_slices, shell)
+            print(f"{int(filled_slice.sum()):>10} {shell.size:>10} {'-':>10} {time_slice:>10.4f} "
+                  f"{'-':>10} {peak_slice / 2 ** 20:>10.1f} {'-':>8}")
+            continue
+        filled_3d, time_3d, peak_3d = timed_fill(binary_fill_holes, shell)
+        filled_slice, time_slice, peak_slice = timed_fill(fill_slices, shell.copy())
+        iou = (filled_3d & filled_slice).sum() / max((filled_3d | filled_slice).sum(), 1)
+        print(f"{int(filled_3d.sum()):>10} {shell.size:>10} {time_3d:>10.4f} {time_slice:>10.4f} "
+              f"{peak_3d / 2 ** 20:>10.1f} {peak_slice / 2 ** 20:>10.1f} {iou:>8.4f}")
+    return 0
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+
+    parser.add_argument('--benchmark', '-b', type=str, default="readback", choices=["readback", "engine", "fill", "tiny"],
+                        help="Benchmark to run.  readback compares reading voxels out of an open3d VoxelGrid one at a "
+                             "time with marking the surface straight into the mask, as rasterize_single_mesh does.  "
+                             "engine compares the speed and agreement of the rasterize_single_mesh engines.  fill "
+                             "compares filling thin diagonal tubes in 3d and slice by slice.  tiny compares rasterizing "
+                             "many small plaques one at a time with rasterizing them together.")
+    parser.add_argument('--sizes', '-sz', type=int, nargs='+', default=[10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7],
+                        help="Approximate number of voxels of each benchmarked mesh.")
+    parser.add_argument('--loop_limit', '-ll', type=int, default=10 ** 6,
+                        help="Largest mesh, in voxels, for which the per-voxel loop readback is also timed.")
+    parser.add_argument('--box_limit', '-bl', type=int, default=2 * 10 ** 8,
+                        help="Largest bounding box, in voxels, for which the 3d fill is also timed.")
+    parser.add_argument('--meshes', '-m', type=int, default=10000,
+                        help="Number of plaques rasterized by the tiny benchmark.")
+
+    args = parser.parse_args()
+
+    if args.benchmark == "readback":
+        benchmark_readback(args.sizes, args.loop_limit)
+    elif args.benchmark == "engine":
+        benchmark_engine(args.sizes)
+    elif args.benchmark == "fill":
+        benchmark_fill(args.sizes, args.box_limit)
+    elif args.benchmark == "tiny":
+        benchmark_tiny(args.meshes)
@@ -0,0 +1,64 @@
+from pathlib import Path
+from numpy import asarray, empty, argsort, searchsorted, maximum, flatnonzero, sort, int64
+from utils import save_npz, load_npz
+
+
+# The bounding boxes of the meshes of a mesh folder, saved next to their masks so the meshes that reach a slab or a
+# region of the image are found without going through every mesh.  Meshes are kept in the order of the mesh index, and
+# z_order sorts them by their minimum z.  reach is the running maximum of their maximum z in that order, so the
+# meshes before the first one whose reach gets to a region all end below it.
+BOUNDS_INDEX_FILE = "_bounds.npz"
+
+
+# names, sizes and modification times of the files the meshes of mesh_filepath are listed in, so a bounds index can
+# tell if the meshes have changed since it was written
+def mesh_files_signature(mesh_filepath: Path):
+    files = sorted(list(mesh_filepath.glob("*/masks*.bin")) + list(mesh_filepath.glob("*/index*.txt")))
+    return "\n".join(f"{f.relative_to(mesh_filepath)},{f.stat().st_size},{f.stat().st_mtime_ns}" for f in files)
+
+
+# bounds index of d, a mesh index as given by build_image.read_mesh_index
+def build_bounds_index(d: dict, signature: str = ""):
+    names = list(d.keys())
+    mins = asarray([d[name]["min"] for name in names], dtype=int64).reshape(-1, 3)
+    maxs = asarray([d[name]["max"] for name in names], dtype=int64).reshape(-1, 3)
+    z_order = argsort(mins[:, 2], kind="stable")
+    return {"signature": asarray(signature),
+            "names": asarray(names) if names else empty(0, dtype="U1"),
+            "mins": mins,
+            "maxs": maxs,
+            "z_order": z_order,
+            "z_mins": mins[z_order, 2],
+            "reach": maximum.accumulate(maxs[z_order, 2]) if len(names) else empty(0, dtype=int64)}
+
+
+# loads the bounds index of the meshes of d from mesh_filepath, rebuilding it if it is missing or the meshes have
+# changed since it was written
+def load_bounds_index(d: dict, mesh_filepath: Path):
+    index_path = mesh_filepath / BOUNDS_INDEX_FILE
+    signature = mesh_files_signature(mesh_filepath)
+    if index_path.exists():
+        bounds_index = load_npz(index_path)
+        if str(bounds_index["signature"]) == signature and len(bounds_index["names"]) == len(d):
+            return bounds_index
+
+    bounds_index = build_bounds_index(d, signature)
+    try:
+        save_npz(index_path, bounds_index)
+    except OSError as e:
+        print(f"WARNING: could not save bounds index in the mesh folder: {e}")
+    return bounds_index
+
+
+# names of the meshes whose bounding box reaches the box from lo up to, but not including, hi, in the order of the
+# mesh index.  Only the meshes that start below hi along z and after the first that reaches lo are checked.
+def query_bounds(bounds_index: dict, lo, hi):
+    lo = asarray(lo, dtype=int64)
+    hi = asarray(hi, dtype=int64)
+    start = searchsorted(bounds_index["reach"], lo[2], side="left")
+    end = searchsorted(bounds_index["z_mins"], hi[2], side="left")
+    if end <= start:
+        return bounds_index["names"][:0]
+    candidates = bounds_index["z_order"][start:end]
+    hits = (bounds_index["mins"][candidates] < hi).all(axis=1) & (bounds_index["maxs"][candidates] >= lo).all(axis=1)
+    return bounds_index["names"][sort(candidates[flatnonzero(hits)])]
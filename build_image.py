@@ -1,70 +1,265 @@
-from utils import load_numpy
+from utils import load_numpy, run_threaded
+from mask_format import paste_mask, read_mask_headers, read_mask
+from object_stats import mask_stats, save_object_table
+from bounds_index import load_bounds_index, query_bounds
+from zarr_output import zarr_path, create_ome_zarr, save_zarr
 from pathlib import Path
-from numpy import zeros, asarray, uint8, rot90
+from numpy import zeros, asarray, uint8, uint16, uint32, rot90, iinfo
+from re import fullmatch
 from tqdm import tqdm
 from tifffile import imwrite
 
 
+# maps each mesh name to its bounds, mask format and where its mask is stored.  Masks in a container have its path
+# and their offset in it; masks saved by earlier versions, one .npy per mesh, are listed in index*.txt files.
 def read_mesh_index(mesh_filepath: Path):
     d = {}
     for dir in mesh_filepath.iterdir():
-        index_file = dir / "index.txt"
+        if not dir.is_dir():
+            continue
         folder = Path(dir).name
-        with index_file.open('r') as f:
-            for line in f:
-                s = line.strip().split(',')
-                # s[0]: mesh index.  s[1], s[2], s[3]: x, y, z coords, respectively
-                d[s[0]] = {"min": [int(float(s[1])), int(float(s[2])), int(float(s[3]))],
-                           "max": [int(float(s[4])), int(float(s[5])), int(float(s[6]))],
-                           "folder": folder}
+        # a folder rasterized in several tasks has one masks_<task>.bin per task
+        for masks_file in sorted(dir.glob("masks*.bin")):
+            for name, header, offset in read_mask_headers(masks_file):
+                d[name] = {"min": header["mins"].tolist(), "max": header["maxs"].tolist(),
+                           "format": header["format"].decode(), "folder": folder, "file": masks_file,
+                           "dtype": header["dtype"].decode(), "nbytes": int(header["nbytes"]), "offset": offset,
+                           "voxels": int(header["voxels"]), "centroid": header["centroid"].tolist(),
+                           "faces": header["faces"].tolist(), "area": float(header["area"])}
+        # a folder rasterized in several tasks has one index_<task>.txt per task
+        for index_file in dir.glob("index*.txt"):
+            with index_file.open('r') as f:
+                for line in f:
+                    s = line.strip().split(',')
+                    # s[0]: mesh index.  s[1], s[2], s[3]: x, y, z coords, respectively.  s[7]: mask format, absent
+                    # from indexes written before masks were encoded
+                    d[s[0]] = {"min": [int(float(s[1])), int(float(s[2])), int(float(s[3]))],
+                               "max": [int(float(s[4])), int(float(s[5])), int(float(s[6]))],
+                               "format": s[7].strip() if len(s) > 7 else "dense",
+                               "folder": folder}
     return d
 
 
-def save_image(data, output_file, flips, dtype=uint8):
+# dtypes of the label image, see label_ids
+LABEL_TYPES = {"uint16": uint16, "uint32": uint32}
+
+
+# label of each mesh in the label image, 0 being the background.  Imaris names meshes _<n>, and such a mesh gets the
+# label n + 1, so labels stay the same across runs and subsets of the surfaces.  If any name is not of this form, the
+# names are numbered from 1 in sorted order instead.
+def label_ids(names):
+    names = sorted(names)
+    if all(fullmatch(r"_?\d+", name) for name in names):
+        ids = {name: int(name.lstrip("_")) + 1 for name in names}
+        if len(set(ids.values())) == len(ids):
+            return ids
+    return {name: i + 1 for i, name in enumerate(names)}
+
+
+# returns -1 if the label ids of names do not fit in label_type, one of LABEL_TYPES
+def check_label_ids(names, label_type: str):
+    ids = label_ids(names)
+    if ids and max(ids.values()) > iinfo(LABEL_TYPES[label_type]).max:
+        print(f"ERROR: mesh labels go up to {max(ids.values())}, which does not fit in {label_type}.")
+        return -1
+    return 0
+
+
+# label ids of names for a label image of dtype label_type, one of LABEL_TYPES, written as (name, id) rows to
+# ids_file.  Returns None if the labels do not fit in label_type.
+def write_label_ids(names, label_type: str, ids_file: Path):
+    if check_label_ids(names, label_type) != 0:
+        return None
+    ids = label_ids(names)
+    ids_file.parent.mkdir(parents=True, exist_ok=True)
+    with ids_file.open('w') as f:
+        f.write("name,id\n")
+        for name, label in ids.items():
+            f.write(f"{name},{label}\n")
+    return ids
+
+
+# saves slice z of data, flipped and rotated as in the saved image, to path
+def save_slice(data, z, path, flips, dtype, binary):
+    layer = rot90(data[::-1 if flips[0] else 1, ::-1 if flips[1] else 1, z])
+    if binary:
+        layer = layer > 0
+    imwrite(path, layer.astype(dtype), dtype=dtype)
+
+
+# with binary, every nonzero voxel is saved as 1, so a label image is saved as a mask.  data may be a slab of an image
+# of depth slices, starting at slice z_offset, in which case its slices are numbered as in the whole image.  With
+# threads, slices are encoded and written by that many threads at once; each thread holds the copy of one slice, so at
+# most threads slices are in flight.
+def save_image(data, output_file, flips, dtype=uint8, binary=False, z_offset=0, depth=None, progress=True, threads=1):
     output_file.mkdir(parents=True, exist_ok=True)
-    print("Saving images...")
-    file_num = 0
-    if flips[2]: # if flip z
-        for z in tqdm(range(data.shape[2] - 1, -1, -1)):
-            layer = rot90(data[::-1, ::-1, z]) if flips[0] and flips[1] else \
-                    rot90(data[::-1, :, z]) if flips[0] and not flips[1] else \
-                    rot90(data[:, ::-1, z]) if flips[0] and flips[1] else \
-                    rot90(data[:, :, z])
-
-            path = output_file / (str(file_num) + ".tif")
-            imwrite(path, layer.astype(dtype), dtype=dtype)
-            file_num += 1
-    else:
-        for z in tqdm(range(data.shape[2])):
-            layer = rot90(data[::-1, ::-1, z]) if flips[0] and flips[1] else \
-                    rot90(data[::-1, :, z]) if flips[0] and not flips[1] else \
-                    rot90(data[:, ::-1, z]) if not flips[0] and flips[1] else \
-                    rot90(data[:, :, z])
-            path = output_file / (str(file_num) + ".tif")
-            imwrite(path, layer.astype(dtype), dtype=dtype)
-            file_num += 1
+    if progress:
+        print("Saving images...")
+    depth = data.shape[2] if depth is None else depth
+    # with flip z, slice z of the whole image is saved as depth - 1 - z
+    file_nums = [depth - 1 - (z_offset + z) if flips[2] else z_offset + z for z in range(data.shape[2])]
 
+    def save(z):
+        save_slice(data, z, output_file / (str(file_nums[z]) + ".tif"), flips, dtype, binary)
 
-def paste_array(img, arr, position):
-    x, y, z = position
-    paste_region = img[x : x + arr.shape[0], y : y + arr.shape[1], z : z + arr.shape[2]]
-    paste_region[arr] = True
+    return run_threaded(save, range(data.shape[2]), threads, progress, "saving images")
 
 
-def build_image(d, mins, maxs, meshes, output, flips):
+def new_image(mins, maxs, dtype=bool):
     image_size = tuple([maxs[i] - mins[i] for i in range(len(mins))])  # may need to add 1 if image is cropped. e.g., maxs[i] - mins[i] + 1 TODO: fix this bug.
-    image = zeros(image_size, dtype=bool)
-
-    count = 0
-    for name, data in tqdm(d.items()):
-        data_min = asarray(data["min"])
-        adjusted_min = data_min - mins
-        folder = data["folder"]
-        arr = load_numpy(meshes / folder / (name + ".npy"))
-        paste_array(image, arr, adjusted_min)
-        count += 1
-
-    save_image(image, output, flips)
+    return zeros(image_size, dtype=dtype)
+
+
+# pastes the meshes names of d into image, whose voxel [0, 0, 0] is at origin, reading their masks from meshes as
+# read_mesh_index lists them.  Parts of meshes outside image are skipped.  ids gives the value of each mesh in a label
+# image.  Statistics missing from d are measured on the way.
+def paste_meshes(image, d, names, origin, meshes, ids=None, progress=True):
+    # meshes of a container are listed in the order they were written, so each container is opened once and read
+    # front to back
+    masks_file = None
+    masks = None
+    try:
+        for name in tqdm(names, disable=not progress):
+            data = d[name]
+            data_min = asarray(data["min"])
+            if "file" in data:
+                if data["file"] != masks_file:
+                    if masks is not None:
+                        masks.close()
+                    masks_file = data["file"]
+                    masks = masks_file.open('rb')
+                masks.seek(data["offset"])
+                arr = read_mask(masks, data["format"], data["dtype"], data["nbytes"])
+            else:
+                arr = load_numpy(meshes / data["folder"] / (name + ".npy"))
+            shape = tuple(asarray(data["max"]) - data_min + 1)
+            if "voxels" not in data:
+                # masks saved by earlier versions are dense and have no statistics
+                data["voxels"], data["centroid"], data["faces"] = mask_stats(arr.reshape(shape), data_min)
+            paste_mask(image, arr, data["format"], shape, data_min - origin, True if ids is None else ids[name])
+    finally:
+        if masks is not None:
+            masks.close()
+
+
+# file listing the label of each mesh in the label image saved to labels_output
+def label_ids_file(labels_output: Path):
+    return labels_output.parent / (labels_output.name + ".csv")
+
+
+# saves image, and with labels, image is a label image and is also saved to labels_output.  z_offset, depth, progress
+# and threads are as for save_image.  With output_format zarr, the image is saved to the OME-Zarr stores of output and
+# labels_output made by create_zarr_images instead.
+def save_images(image, output, flips, labels=None, labels_output=None, z_offset=0, depth=None, progress=True,
+                threads=1, output_format="tif"):
+    if output_format == "zarr":
+        if save_zarr(image, zarr_path(output), flips, binary=True, z_offset=z_offset, depth=depth, progress=progress,
+                     threads=threads) != 0:
+            return -1
+        if labels is None:
+            return 0
+        return save_zarr(image, zarr_path(labels_output), flips, z_offset=z_offset, depth=depth, progress=progress,
+                         threads=threads)
+    if labels is None:
+        return save_image(image, output, flips, z_offset=z_offset, depth=depth, progress=progress, threads=threads)
+    if save_image(image, output, flips, binary=True, z_offset=z_offset, depth=depth, progress=progress,
+                  threads=threads) != 0:
+        return -1
+    return save_image(image, labels_output, flips, dtype=LABEL_TYPES[labels], z_offset=z_offset, depth=depth,
+                      progress=progress, threads=threads)
+
+
+# creates the OME-Zarr stores the image from mins to maxs, and with labels its label image, are saved to by
+# save_images, chunked as chunks, a (z, y, x) shape.  Returns -1 if they cannot be created.
+def create_zarr_images(mins, maxs, output, labels, labels_output, chunks, voxel_sizes):
+    shape = (maxs[2] - mins[2], maxs[1] - mins[1], maxs[0] - mins[0])
+    if create_ome_zarr(zarr_path(output), shape, uint8, chunks, voxel_sizes) is None:
+        return -1
+    if labels is not None and \
+            create_ome_zarr(zarr_path(labels_output), shape, LABEL_TYPES[labels], chunks, voxel_sizes) is None:
+        return -1
+    return 0
+
+
+# with labels, one of LABEL_TYPES, a label image in which each mesh has its label_ids id is also saved to
+# labels_output.  With objects_output, the statistics of every mesh are saved there as by
+# object_stats.save_object_table, using voxel_sizes.  With slab_depth, the image is assembled and saved slab_depth
+# z-slices at a time, each slab holding only the meshes that reach it, so memory is bound by the slab instead of the
+# whole image.  The meshes that reach the image, or each slab, are found with the bounds index of the mesh folder.
+# Slices are saved by threads threads, as by save_image.  output_format is one of zarr_output.OUTPUT_FORMATS, and
+# with zarr the images are saved to OME-Zarr stores with chunks of shape chunks instead of .tif folders.
+def build_image(d, mins, maxs, meshes, output, flips, labels=None, labels_output=None, voxel_sizes=None,
+                objects_output=None, slab_depth=0, threads=1, output_format="tif", chunks=None):
+    ids = None
+    if labels is not None:
+        ids = write_label_ids(d.keys(), labels, label_ids_file(labels_output))
+        if ids is None:
+            return -1
+    image_type = bool if ids is None else LABEL_TYPES[labels]
+    mins = asarray(mins)
+    maxs = asarray(maxs)
+    if output_format == "zarr" and \
+            create_zarr_images(mins, maxs, output, labels, labels_output, chunks, voxel_sizes) != 0:
+        return -1
+    bounds_index = load_bounds_index(d, meshes)
+
+    depth = int(maxs[2] - mins[2])
+    if not slab_depth or slab_depth >= depth:
+        image = new_image(mins, maxs, image_type)
+        paste_meshes(image, d, query_bounds(bounds_index, mins, maxs), mins, meshes, ids)
+    else:
+        n_slabs = -(-depth // slab_depth)
+        print(f"Assembling and saving {n_slabs} slabs of {slab_depth} slices...")
+        for z0 in tqdm(range(0, depth, slab_depth)):
+            z1 = min(z0 + slab_depth, depth)
+            slab = new_image(mins, [maxs[0], maxs[1], mins[2] + z1 - z0], image_type)
+            slab_names = query_bounds(bounds_index, mins + [0, 0, z0], [maxs[0], maxs[1], mins[2] + z1])
+            paste_meshes(slab, d, slab_names, mins + [0, 0, z0], meshes, ids, progress=False)
+            if save_images(slab, output, flips, labels, labels_output, z_offset=z0, depth=depth, progress=False,
+                           threads=threads, output_format=output_format) != 0:
+                return -1
+            del slab
+
+    if objects_output is not None:
+        # meshes saved by earlier versions that lie outside the image were not pasted, so their statistics are
+        # measured by pasting them into an empty image
+        missing = [name for name in d if "voxels" not in d[name]]
+        paste_meshes(new_image([0, 0, 0], [0, 0, 0]), d, missing, mins, meshes, progress=False)
+        save_object_table(d, ids or label_ids(d.keys()), voxel_sizes, objects_output)
+    if not slab_depth or slab_depth >= depth:
+        return save_images(image, output, flips, labels, labels_output, threads=threads, output_format=output_format)
+    return 0
+
+
+# builds the image from (name, mask, mesh mins, mesh maxs, surface area) tuples as they are rasterized, without
+# reading np_meshes.
+# total is only used for the progress bar.  labels and labels_output are as for build_image, names listing every mesh
+# name the stream may contain.  voxel_sizes, objects_output, threads, output_format and chunks are as for build_image.
+def build_image_from_stream(stream, mins, maxs, output, flips, total=None, labels=None, labels_output=None,
+                            names=None, voxel_sizes=None, objects_output=None, threads=1, output_format="tif",
+                            chunks=None):
+    ids = None
+    if labels is not None:
+        ids = write_label_ids(names, labels, label_ids_file(labels_output))
+        if ids is None:
+            return -1
+    if output_format == "zarr" and \
+            create_zarr_images(mins, maxs, output, labels, labels_output, chunks, voxel_sizes) != 0:
+        return -1
+    image = new_image(mins, maxs, bool if ids is None else LABEL_TYPES[labels])
+
+    d = {}
+    for name, arr, mesh_mins, mesh_maxs, area in tqdm(stream, total=total):
+        adjusted_min = asarray(mesh_mins, dtype=int) - mins
+        paste_mask(image, arr, "dense", arr.shape, adjusted_min, True if ids is None else ids[name])
+        if objects_output is not None:
+            voxels, centroid, faces = mask_stats(arr, mesh_mins)
+            d[name] = {"min": asarray(mesh_mins, dtype=int).tolist(), "max": asarray(mesh_maxs, dtype=int).tolist(),
+                       "voxels": voxels, "centroid": centroid, "faces": faces, "area": area}
+
+    if objects_output is not None:
+        save_object_table(d, ids or label_ids(names), voxel_sizes, objects_output)
+    return save_images(image, output, flips, labels, labels_output, threads=threads, output_format=output_format)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,201 @@
+from numpy import ndarray, empty, zeros, asarray, packbits, frombuffer, maximum, minimum, dtype, int64, uint32, nan
+from numba import jit
+from pathlib import Path
+
+
+# dense: one byte per voxel, as written by earlier versions
+# packbits: one bit per voxel, from numpy.packbits of the flattened mask
+# rle: runs of filled voxels along z, as (start, length) pairs, start being the index of the run's first voxel in the
+#      flattened mask.  Runs never cross from one (x, y) row into the next.
+MASK_FORMATS = ["dense", "packbits", "rle"]
+DEFAULT_MASK_FORMAT = "packbits"
+
+
+@jit(nopython=True, cache=True)
+def encode_runs(flat, row_length):
+    # at most every other voxel of each row starts a run
+    runs = empty((len(flat) // row_length * ((row_length + 1) // 2), 2), dtype=int64)
+    count = 0
+    i = 0
+    while i < len(flat):
+        if not flat[i]:
+            i += 1
+            continue
+        start = i
+        i += 1
+        while i < len(flat) and flat[i] and i % row_length != 0:
+            i += 1
+        runs[count, 0] = start
+        runs[count, 1] = i - start
+        count += 1
+    return runs[:count]
+
+
+# sets the voxels of each run of a mask of the given shape, placed at position in image, to value, unless they already
+# hold a larger one.  Voxels outside image are skipped.
+@jit(nopython=True, cache=True)
+def paste_runs(image, runs, shape, position, value):
+    row_length = shape[2]
+    plane_size = shape[1] * shape[2]
+    for r in range(len(runs)):
+        start = int64(runs[r, 0])
+        x = start // plane_size + position[0]
+        y = (start // row_length) % shape[1] + position[1]
+        if x < 0 or x >= image.shape[0] or y < 0 or y >= image.shape[1]:
+            continue
+        z = start % row_length + position[2]
+        for k in range(max(z, 0), min(z + int64(runs[r, 1]), image.shape[2])):
+            if image[x, y, k] < value:
+                image[x, y, k] = value
+
+
+# sets the voxels of the set bits of a packed mask of the given shape, placed at position in image, to value, unless
+# they already hold a larger one.  Voxels outside image are skipped.
+@jit(nopython=True, cache=True)
+def paste_bits(image, packed, shape, position, value):
+    size = shape[0] * shape[1] * shape[2]
+    for b in range(len(packed)):
+        byte = packed[b]
+        if byte == 0:
+            continue
+        flat = b * 8
+        x = flat // (shape[1] * shape[2])
+        y = (flat // shape[2]) % shape[1]
+        z = flat % shape[2]
+        for bit in range(min(8, size - flat)):
+            if byte & (128 >> bit):
+                i = x + position[0]
+                j = y + position[1]
+                k = z + position[2]
+                if 0 <= i < image.shape[0] and 0 <= j < image.shape[1] and 0 <= k < image.shape[2] \
+                        and image[i, j, k] < value:
+                    image[i, j, k] = value
+            z += 1
+            if z == shape[2]:
+                z = 0
+                y += 1
+                if y == shape[1]:
+                    y = 0
+                    x += 1
+
+
+# encodes a boolean mask in mask_format for saving
+def encode_mask(mask: ndarray, mask_format: str = DEFAULT_MASK_FORMAT):
+    if mask_format == "packbits":
+        return packbits(mask, axis=None)
+    if mask_format == "rle":
+        runs = encode_runs(mask.ravel(), mask.shape[2])
+        return runs.astype(uint32) if mask.size < 2 ** 32 else runs
+    return mask
+
+
+# pastes a mask of the given shape, saved by encode_mask, into image at position.  Packed and run-length masks are
+# pasted as they are, without being decoded into a dense mask first.  The voxels of the mask are set to value, so a
+# label image can be built, and where masks overlap the largest value is kept.  Voxels outside image are skipped, so
+# a mask can be pasted into part of a larger image.
+def paste_mask(image: ndarray, data: ndarray, mask_format: str, shape: tuple, position, value=True):
+    position = asarray(position, dtype=int64)
+    value = image.dtype.type(value)
+    if mask_format == "packbits":
+        paste_bits(image, data, asarray(shape, dtype=int64), position, value)
+        return
+    if mask_format == "rle":
+        paste_runs(image, data, asarray(shape, dtype=int64), position, value)
+        return
+    data = data.reshape(shape)
+    lo = maximum(position, 0)
+    hi = minimum(position + asarray(shape, dtype=int64), image.shape)
+    if (hi <= lo).any():
+        return
+    paste_region = image[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+    lo -= position
+    hi -= position
+    data = data[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+    paste_region[data] = maximum(paste_region[data], value)
+
+
+# Masks of a chunk are appended to a single container file, MASKS_FILE, instead of one .npy per mesh.  Each record is
+# a RECORD_HEADER, the mesh name in utf-8, then the encoded mask.  Records are only ever appended, so a chunk is read
+# back with one open and sequential reads, and the container doubles as a journal of the meshes rasterized so far.
+# The header also holds the statistics of object_stats.mask_stats and the surface area of the mesh.  Records written
+# before the area was stored have a LEGACY_RECORD_HEADER, told apart by its magic.
+MASKS_FILE = "masks.bin"
+RECORD_MAGIC = b"MSK2"
+RECORD_HEADER = dtype([("magic", "S4"), ("name_length", "<u4"), ("mins", "<i8", (3,)), ("maxs", "<i8", (3,)),
+                       ("format", "S8"), ("dtype", "S4"), ("nbytes", "<u8"),
+                       ("voxels", "<i8"), ("centroid", "<f8", (3,)), ("faces", "<i8", (3,)), ("area", "<f8")])
+LEGACY_RECORD_MAGIC = b"MASK"
+LEGACY_RECORD_HEADER = dtype([("magic", "S4"), ("name_length", "<u4"), ("mins", "<i8", (3,)), ("maxs", "<i8", (3,)),
+                              ("format", "S8"), ("dtype", "S4"), ("nbytes", "<u8"),
+                              ("voxels", "<i8"), ("centroid", "<f8", (3,)), ("faces", "<i8", (3,))])
+RECORD_HEADERS = {RECORD_MAGIC: RECORD_HEADER, LEGACY_RECORD_MAGIC: LEGACY_RECORD_HEADER}
+
+
+# appends the mask of mesh name, encoded as data in mask_format, its (voxels, centroid, faces) stats and the area of
+# its surface to the open container file
+def write_mask_record(file, name: str, mins, maxs, mask_format: str, data: ndarray, stats: tuple, area: float):
+    name = name.encode()
+    header = zeros(1, dtype=RECORD_HEADER)
+    header["magic"] = RECORD_MAGIC
+    header["name_length"] = len(name)
+    header["mins"] = asarray(mins, dtype=int64)
+    header["maxs"] = asarray(maxs, dtype=int64)
+    header["format"] = mask_format
+    header["dtype"] = data.dtype.str
+    header["nbytes"] = data.nbytes
+    header["voxels"], header["centroid"], header["faces"] = stats
+    header["area"] = area
+    # one write per record, flushed, so an interrupted run leaves at most the last record incomplete
+    file.write(header.tobytes() + name + data.tobytes())
+    file.flush()
+
+
+# a RECORD_HEADER holding the fields of a LEGACY_RECORD_HEADER, with an area of nan
+def upgrade_header(header):
+    upgraded = zeros(1, dtype=RECORD_HEADER)[0]
+    for field in LEGACY_RECORD_HEADER.names:
+        upgraded[field] = header[field]
+    upgraded["area"] = nan
+    return upgraded
+
+
+# yields (name, RECORD_HEADER, offset of the mask) for each record of the container at path, skipping over the masks.
+# A record cut short, by a run that was interrupted while writing it, ends the container.
+def read_mask_headers(path: Path):
+    size = path.stat().st_size
+    with path.open('rb') as file:
+        while file.tell() + len(RECORD_MAGIC) <= size:
+            header_type = RECORD_HEADERS.get(file.read(len(RECORD_MAGIC)))
+            file.seek(-len(RECORD_MAGIC), 1)
+            if header_type is None or file.tell() + header_type.itemsize > size:
+                return
+            header = frombuffer(file.read(header_type.itemsize), dtype=header_type)[0]
+            if header_type is LEGACY_RECORD_HEADER:
+                header = upgrade_header(header)
+            name = file.read(int(header["name_length"])).decode()
+            offset = file.tell()
+            if offset + int(header["nbytes"]) > size:
+                return
+            yield name, header, offset
+            file.seek(int(header["nbytes"]), 1)
+
+
+# reads a mask of nbytes bytes, saved with encode_mask in mask_format, from the current position of the open container
+# file
+def read_mask(file, mask_format: str, mask_dtype: str, nbytes: int):
+    data = frombuffer(file.read(nbytes), dtype=mask_dtype)
+    return data.reshape(-1, 2) if mask_format == "rle" else data
+
+
+# names of the meshes whose records in the container at path are complete.  Anything after the last complete record,
+# left by an interrupted run, is truncated, so new records can be appended.
+def recover_mask_names(path: Path):
+    names = []
+    end = 0
+    for name, header, offset in read_mask_headers(path):
+        names.append(name)
+        end = offset + int(header["nbytes"])
+    if path.stat().st_size > end:
+        with path.open('r+b') as file:
+            file.truncate(end)
+    return names
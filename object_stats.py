@@ -0,0 +1,74 @@
+from numpy import ndarray, zeros, asarray, save, cross, float64, int64, nan
+from numpy.linalg import norm
+from numba import jit
+from pathlib import Path
+
+
+# Per-mesh statistics, measured on each mask as it is rasterized so they need no pass over the assembled image.
+# Positions are in voxels of the image grid, as the bounds of each mesh; volume and areas are in the units of the input
+# file.  surface_area is the area of the mesh's triangles, and voxel_surface_area that of the exposed faces of its
+# voxels, which overstates it by up to about 3 times for small meshes.
+def object_dtype(name_length: int):
+    return [("name", f"U{max(name_length, 1)}"), ("id", "<i8"), ("voxels", "<i8"), ("volume", "<f8"),
+            ("centroid", "<f8", (3,)), ("min", "<i8", (3,)), ("max", "<i8", (3,)), ("surface_area", "<f8"),
+            ("voxel_surface_area", "<f8")]
+
+
+# number of filled voxels of image, the sum of their indices along each axis, and the number of their faces normal to
+# each axis that border an empty voxel or the edge of the image
+@jit(nopython=True, cache=True)
+def count_mask(image):
+    nx, ny, nz = image.shape
+    voxels = 0
+    sums = zeros(3, dtype=float64)
+    faces = zeros(3, dtype=int64)
+    for i in range(nx):
+        for j in range(ny):
+            for k in range(nz):
+                if not image[i, j, k]:
+                    continue
+                voxels += 1
+                sums[0] += i
+                sums[1] += j
+                sums[2] += k
+                faces[0] += (i == 0 or not image[i - 1, j, k]) + (i == nx - 1 or not image[i + 1, j, k])
+                faces[1] += (j == 0 or not image[i, j - 1, k]) + (j == ny - 1 or not image[i, j + 1, k])
+                faces[2] += (k == 0 or not image[i, j, k - 1]) + (k == nz - 1 or not image[i, j, k + 1])
+    return voxels, sums, faces
+
+
+# voxel count, centroid and exposed faces along each axis of the mask image of a mesh with minimum corner mins
+def mask_stats(image: ndarray, mins):
+    voxels, sums, faces = count_mask(image)
+    centroid = asarray(mins, dtype=float64) + sums / max(voxels, 1)
+    return voxels, centroid, faces
+
+
+# total area of the triangles faces, rows of 3 indices into vertices, in the units of vertices.  Only the corners of
+# the triangles are converted, so vertices may be a large array shared by many meshes.
+def mesh_area(faces: ndarray, vertices: ndarray):
+    corners = asarray(vertices)[asarray(faces)].astype(float64)
+    return 0.5 * float(norm(cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=1).sum())
+
+
+# saves the statistics of every mesh of d, a dict of mesh name to its "min", "max", "voxels", "centroid", "faces" and
+# "area" as in build_image.read_mesh_index, as a structured array in object_file.  ids gives the id of each mesh.
+# Meshes whose area was not recorded, by earlier versions, have a surface_area of nan.
+def save_object_table(d: dict, ids: dict, voxel_sizes: list, object_file: Path):
+    dx, dy, dz = voxel_sizes
+    names = list(d)
+    table = zeros(len(names), dtype=object_dtype(max((len(name) for name in names), default=1)))
+    if names:
+        faces = asarray([d[name]["faces"] for name in names], dtype=float64)
+        table["name"] = names
+        table["id"] = [ids[name] for name in names]
+        table["voxels"] = [d[name]["voxels"] for name in names]
+        table["volume"] = table["voxels"] * (dx * dy * dz)
+        table["centroid"] = [d[name]["centroid"] for name in names]
+        table["min"] = [d[name]["min"] for name in names]
+        table["max"] = [d[name]["max"] for name in names]
+        table["surface_area"] = [d[name].get("area", nan) for name in names]
+        table["voxel_surface_area"] = faces[:, 0] * dy * dz + faces[:, 1] * dx * dz + faces[:, 2] * dx * dy
+    object_file.parent.mkdir(parents=True, exist_ok=True)
+    save(object_file, table)
+    return table
@@ -0,0 +1,99 @@
+from pathlib import Path
+from shutil import rmtree
+from hashlib import blake2b
+from utils import COORDS_SUBFOLDER, NORMALS_SUBFOLDER, INDICES_SUBFOLDER
+
+
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "imaris_surface_parser"
+FINGERPRINT_SAMPLES = 64  # number of blocks hashed from the input file
+FINGERPRINT_SAMPLE_SIZE = 1 << 20  # bytes per hashed block
+PARTIAL_SUFFIX = ".partial"
+PARSE_FORMAT = 1  # version of the layout of parsed files.  Changing it gives every input a new key.
+LAST_USED_FILE = "last_used"
+
+
+# identifies an input file by its size, modification time and a hash of FINGERPRINT_SAMPLES blocks spread evenly
+# through it, so large files are fingerprinted without being read in full.  PARSE_FORMAT is included, so entries parsed
+# in an older layout are not used.
+def fingerprint(filepath: Path):
+    stat = filepath.stat()
+    h = blake2b(f"{PARSE_FORMAT}:{stat.st_size}:{stat.st_mtime_ns}".encode('utf-8'), digest_size=16)
+    with open(filepath, 'rb') as f:
+        step = max(stat.st_size // FINGERPRINT_SAMPLES, FINGERPRINT_SAMPLE_SIZE)
+        for offset in range(0, stat.st_size, step):
+            f.seek(offset)
+            h.update(f.read(FINGERPRINT_SAMPLE_SIZE))
+        # always include the end of the file
+        f.seek(max(stat.st_size - FINGERPRINT_SAMPLE_SIZE, 0))
+        h.update(f.read(FINGERPRINT_SAMPLE_SIZE))
+    return h.hexdigest()
+
+
+# records that entry was just used, for least recently used eviction
+def touch_entry(entry: Path):
+    (entry / LAST_USED_FILE).touch()
+
+
+# returns the finished cache entry for key, or None if there is none
+def lookup(cache_root: Path, key: str):
+    entry = cache_root / key
+    if not entry.is_dir():
+        return None
+    touch_entry(entry)
+    return entry
+
+
+# returns the folder a new entry for key is written to.  An interrupted entry is kept when resume is True, so parsing
+# can continue with --skip_to, and removed otherwise.  Returns None if resume is True but there is no interrupted entry.
+def begin(cache_root: Path, key: str, resume: bool = False):
+    partial = cache_root / (key + PARTIAL_SUFFIX)
+    if resume and not partial.is_dir():
+        return None
+    if partial.exists() and not resume:
+        rmtree(partial)
+    partial.mkdir(parents=True, exist_ok=True)
+    touch_entry(partial)
+    return partial
+
+
+# marks the entry for key as complete and returns its folder.  Returns None, leaving the entry partial, if its
+# coordinates or triangles are missing.  Normals may be absent from .ims inputs, so only their folder is required.
+def commit(cache_root: Path, key: str):
+    partial = cache_root / (key + PARTIAL_SUFFIX)
+    if not any((partial / COORDS_SUBFOLDER).glob("*.npy")) or not (partial / NORMALS_SUBFOLDER).is_dir() or \
+            not (partial / INDICES_SUBFOLDER / "_index.npy").is_file():
+        print(f"ERROR: the parse in {partial} is incomplete and was not added to the cache.")
+        return None
+    entry = cache_root / key
+    if entry.exists():
+        rmtree(entry)
+    partial.rename(entry)
+    touch_entry(entry)
+    return entry
+
+
+def entry_size(entry: Path):
+    return sum(f.stat().st_size for f in entry.rglob('*') if f.is_file())
+
+
+def last_used(entry: Path):
+    marker = entry / LAST_USED_FILE
+    return marker.stat().st_mtime if marker.exists() else entry.stat().st_mtime
+
+
+# deletes the least recently used finished entries until they hold at most max_bytes.  The entry for keep is never
+# deleted, even if it alone is larger than max_bytes.  Partial entries are neither counted nor deleted, as another run
+# may still be writing them, or resume them with --skip_to.
+def evict(cache_root: Path, max_bytes: int, keep: str = None):
+    if not cache_root.exists():
+        return
+    entries = [entry for entry in cache_root.iterdir()
+               if entry.is_dir() and entry.name != keep and not entry.name.endswith(PARTIAL_SUFFIX)]
+    sizes = {entry: entry_size(entry) for entry in entries}
+    total = sum(sizes.values()) + (entry_size(cache_root / keep) if keep and (cache_root / keep).exists() else 0)
+    for entry in sorted(entries, key=last_used):
+        if total <= max_bytes:
+            break
+        print(f"Evicting cached parse {entry.name}")
+        rmtree(entry)
+        total -= sizes[entry]
@@ -1,176 +1,235 @@
 from argparse import ArgumentParser
 from pathlib import Path
 from shutil import rmtree
-from utils import save_numpy
+from warnings import catch_warnings, simplefilter
+from mmap import mmap, ACCESS_READ
+from multiprocessing import Pool
+from tqdm import tqdm
+from utils import save_numpy, save_faces, split_faces
+from utils import COORDS_SUBFOLDER, INDICES_SUBFOLDER, NORMALS_SUBFOLDER, MESH_SUBFOLDER, IMAGE_SUBFOLDER
+from utils import LABELS_SUBFOLDER, OBJECTS_FILE
+from utils import VECTOR_FILE_ROWS, DEFS_PER_FILE
+from wrl_index import load_wrl_index
+from read_ims import read_ims, read_ims_layout, stream_ims, iter_ims_meshes
+from parse_cache import DEFAULT_CACHE_DIR, fingerprint, lookup, begin, commit, evict
+from numpy import fromstring, concatenate, empty, float32, float64, int64
+from math import floor, ceil
 
-from rasterize_mesh import rasterize_all_indices
-from build_image import read_mesh_index, build_image
+from rasterize_mesh import rasterize_all_indices, rasterize_stream, RasterizeQueue, ENGINES, FILLS
+from mask_format import MASK_FORMATS, DEFAULT_MASK_FORMAT
+from zarr_output import OUTPUT_FORMATS, DEFAULT_CHUNKS, check_zarr
+from build_image import read_mesh_index, build_image, build_image_from_stream, check_label_ids, LABEL_TYPES
 
 from numba import jit
 
 
-COORDS_SUBFOLDER = "np_coords"
-INDICES_SUBFOLDER = "np_indices"
-NORMALS_SUBFOLDER = "np_normals"
-MESH_SUBFOLDER = "np_meshes"
-IMAGE_SUBFOLDER = "image"
+VECTOR_BLOCK_SIZE = 1 << 26  # bytes converted at a time from the Coordinate and Normal arrays
+COMMA_TO_SPACE = bytes.maketrans(b',', b' ')
 
 
-# voxel_sizes is a list [x, y, z]
+# converts the whitespace-separated numbers in data.  Older numpy versions of fromstring stop at the first token that
+# is not a number and only warn, returning the values before it, so the warning is raised as a ValueError naming what.
+def parse_numbers(data: bytes, dtype, what: str):
+    # fromstring reads a lone -1 from a string of only whitespace
+    if data.isspace():
+        return empty(0, dtype=dtype)
+    with catch_warnings():
+        simplefilter("error", DeprecationWarning)
+        try:
+            return fromstring(data, dtype=dtype, sep=' ')
+        except (DeprecationWarning, ValueError):
+            raise ValueError(f"bad wrl format - {what} contains a value that is not a number.") from None
+
+
+# parses the "x y z," rows of a Coordinate or Normal array held in buffer[start:end].  Rows are converted in bulk, one
+# block of about VECTOR_BLOCK_SIZE bytes at a time.  Yields one (N, 3) array of the given dtype per block.
+def iter_vector_rows(buffer, start: int, end: int, dtype=float64):
+    pos = start
+    while pos < end:
+        # only convert complete rows; the block is cut after the last comma it contains
+        cut = buffer.rfind(b',', pos, min(pos + VECTOR_BLOCK_SIZE, end)) + 1
+        if cut == 0 or pos + VECTOR_BLOCK_SIZE >= end:
+            cut = end
+        values = parse_numbers(buffer[pos:cut].translate(COMMA_TO_SPACE), float64, "Coordinate or Normal array")
+        pos = cut
+        if values.size % 3 != 0:
+            raise ValueError("bad wrl format - array rows must contain 3 values.")
+        yield values.reshape(-1, 3).astype(dtype, copy=False)
+
+
+# saves the rows of a Coordinate or Normal array (see iter_vector_rows) as <prefix>_N.npy files of VECTOR_FILE_ROWS rows
+def read_vector_block(buffer, start: int, end: int, output_folder: Path, prefix: str, dtype=float64):
+    file_count = 0
+    rows = []
+    row_count = 0
+    for values in iter_vector_rows(buffer, start, end, dtype):
+        rows.append(values)
+        row_count += len(values)
+        while row_count >= VECTOR_FILE_ROWS:
+            data = concatenate(rows)
+            save_numpy(output_folder / f"{prefix}_{file_count}.npy", data[:VECTOR_FILE_ROWS])
+            rows = [data[VECTOR_FILE_ROWS:]]
+            row_count = len(rows[0])
+            file_count += 1
+    if row_count > 0:
+        save_numpy(output_folder / f"{prefix}_{file_count}.npy", concatenate(rows))
+
+
+# splits the coordIndex array buffer[start:end] into faces at each -1.  Returns the (F, 3) faces and the min and max
+# coordinate index they reference.
+def read_faces(buffer, start: int, end: int, name: str = ""):
+    flat = parse_numbers(buffer[start:end].translate(COMMA_TO_SPACE), int64, f"DEF {name}")
+    faces, overall_min, overall_max, bad_length = split_faces(flat)
+    if bad_length:
+        raise ValueError(f"DEF {name} has a face with {bad_length} vertices, only triangles are supported.")
+    return faces, int(overall_min), int(overall_max)
+
+
+# parses the coordIndex arrays buffer[def_starts[i]:def_ends[i]] into one indices_N folder (see utils.save_faces).
+# args is a tuple (wrl filepath, output folder, def_names, def_starts, def_ends).  Returns the folder's name and the
+# [min, max] of the coordinate indices it references.
+def read_triangle_file(args: tuple):
+    filepath, output_folder, def_names, def_starts, def_ends = args
+    names = []
+    faces = []
+    counts = []
+    overall_min = 9999999999
+    overall_max = -1
+    with open(filepath, 'rb') as infile, mmap(infile.fileno(), 0, access=ACCESS_READ) as mm:
+        for name, start, end in zip(def_names, def_starts, def_ends):
+            arr, arr_min, arr_max = read_faces(mm, start, end, name)
+            overall_min = min(overall_min, arr_min)
+            overall_max = max(overall_max, arr_max)
+            names.append(str(name))
+            faces.append(arr)
+            counts.append(len(arr))
+    save_faces(output_folder, names, concatenate(faces), counts)
+    return output_folder.name, [overall_min, overall_max]
+
+
+# yields (name, faces) for every DEF of the .wrl file, parsed straight from the memory-mapped triangle section
+def iter_wrl_meshes(filepath: Path, wrl_index: dict):
+    with open(filepath, 'rb') as infile, mmap(infile.fileno(), 0, access=ACCESS_READ) as mm:
+        for name, start, end in zip(wrl_index["def_names"], wrl_index["def_starts"], wrl_index["def_ends"]):
+            yield str(name), read_faces(mm, start, end, name)[0]
+
+
+# streaming counterpart of read_wrl: returns the physical coordinates held in memory and the section index, whose
+# meshes can then be read with iter_wrl_meshes without writing any intermediate files.  Normals are not read.
+def stream_wrl(filepath: Path):
+    wrl_index = load_wrl_index(filepath)
+    if wrl_index is None:
+        return None
+
+    print("Parsing coordinates")
+    with open(filepath, 'rb') as infile, mmap(infile.fileno(), 0, access=ACCESS_READ) as mm:
+        start, end = wrl_index["coords"]
+        coords = concatenate(list(iter_vector_rows(mm, int(start), int(end), float32)))
+    return coords, wrl_index
+
+
+# coordinates are saved as float32 in physical units; voxel sizes are only applied when meshes are rasterized.
 # skip_to = 0: start from coords, skip_to = 1: start from normals, skip_to = 2: start from triangles
-def read_wrl(filepath: Path, output_path: Path, voxel_sizes: list, skip_to: int = 0):
-    with open(filepath, 'r', encoding='utf-8') as infile:
-        file_count = 0
-        in_coords = False
-        in_normals = False
-        in_triangles = False
-        line = ""
-        while not in_coords:
-            line = infile.readline()
-            if "Coordinate" in line:
-                in_coords = True
-        if not in_coords:
-            print("ERROR: bad wrl format - cannot find coordinates.")
-            return -1
+# sections are located through the section index (see wrl_index.py), so skipped sections are never read.
+# the triangle section is parsed by a pool of threads processes, one indices_N folder per task.
+# on_triangle_file(folder, [min, max]) is called in this process as soon as each indices_N folder is written.
+def read_wrl(filepath: Path, output_path: Path, skip_to: int = 0, threads: int = 1, on_triangle_file=None):
+    wrl_index = load_wrl_index(filepath)
+    if wrl_index is None:
+        return -1
 
+    with open(filepath, 'rb') as infile, mmap(infile.fileno(), 0, access=ACCESS_READ) as mm:
         coords_path = output_path / COORDS_SUBFOLDER
         coords_path.mkdir(exist_ok=True)
 
         # loop through coords
-        print("Parsing coordinates")
         if skip_to >= 1:
-            line = infile.readline()
             print("Skipping parsing coordinates")
-            while ']' not in line:
-                line = infile.readline()
-            in_coords = False
-        while in_coords:
-            coords = []
-            line_count = 0
-            while line_count < 1000000:
-                line = infile.readline()
-                if ']' not in line:
-                    coord = (line.split(',')[0]).split(' ')[-3:]
-                    coord = [int(c // voxel_sizes[i]) for i, c in enumerate(map(float, coord))]
-                    coords.append(coord)
-                    line_count += 1
-                else:
-                    coord = (line.split(']')[0]).strip().split(' ')[-3:]
-                    coord = [int(c // voxel_sizes[i]) for i, c in enumerate(map(float, coord))]
-                    coords.append(coord)
-                    in_coords = False
-                    break
-            save_numpy(coords_path / f"coord_{file_count}.npy", coords)
-            file_count += 1
-
-        while not in_normals:
-            line = infile.readline()
-            if "{" in line:
-                in_normals = True
-        if not in_normals:
-            print("ERROR: bad wrl format - cannot find normals.")
-            return -1
+        else:
+            print("Parsing coordinates")
+            start, end = wrl_index["coords"]
+            read_vector_block(mm, int(start), int(end), coords_path, "coord", float32)
 
         normals_path = output_path / NORMALS_SUBFOLDER
         normals_path.mkdir(exist_ok=True)
-        file_count = 0
 
         # loop through normals
-        print("Parsing normals")
         if skip_to >= 2:
-            line = infile.readline()
             print("Skipping parsing normals")
-            while ']' not in line:
-                line = infile.readline()
-            in_normals = False
-        while in_normals:
-            normals = []
-            line_count = 0
-            while line_count < 1000000:
-                line = infile.readline()
-                if ']' not in line:
-                    normal = (line.split(',')[0]).split(' ')[-3:]
-                    normal = list(map(float, normal))
-                    normals.append(normal)
-                    line_count += 1
-                else:
-                    normal = (line.split(']')[0]).strip().split(' ')[-3:]
-                    normal = list(map(float, normal))
-                    normals.append(normal)
-                    in_normals = False
-                    break
-            save_numpy(normals_path / f"normal_{file_count}.npy", normals)
-            file_count += 1
+        else:
+            print("Parsing normals")
+            start, end = wrl_index["normals"]
+            read_vector_block(mm, int(start), int(end), normals_path, "normal")
+
+    # loop through triangles, split at DEF boundaries into DEFS_PER_FILE arrays per indices_N folder
+    print("Parsing triangles")
+    triangles_path = output_path / INDICES_SUBFOLDER
+    triangles_path.mkdir(exist_ok=True)
+    def_names = wrl_index["def_names"]
+    def_starts = wrl_index["def_starts"]
+    def_ends = wrl_index["def_ends"]
+    params = []
+    for file_count, first in enumerate(range(0, len(def_names), DEFS_PER_FILE)):
+        last = first + DEFS_PER_FILE
+        params.append(tuple([filepath, triangles_path / f"indices_{file_count}",
+                             def_names[first:last], def_starts[first:last], def_ends[first:last]]))
 
-        # loop through triangles
-        print("Parsing triangles")
-        raw_arr = []
-        while not in_triangles:
-            line = infile.readline()
-            if "coordIndex" in line:
-                in_triangles = True
-                nums = [int(n) for n in (line.split('[')[1]).strip().split(',') if n]
-                raw_arr += nums
-        if not in_triangles:
-            print("ERROR: bad wrl format - cannot find triangles.")
+    triangle_index = {}
+    if threads == 1:
+        for name, bounds in tqdm(map(read_triangle_file, params), total=len(params)):
+            triangle_index[name] = bounds
+            if on_triangle_file is not None:
+                on_triangle_file(triangles_path / name, bounds)
+    else:
+        pool = Pool(processes=threads)
+        try:
+            for name, bounds in tqdm(pool.imap_unordered(read_triangle_file, params), total=len(params)):
+                triangle_index[name] = bounds
+                if on_triangle_file is not None:
+                    on_triangle_file(triangles_path / name, bounds)
+        except KeyboardInterrupt:
+            print("KeyboardInterrupt detected, terminating thread pool...")
+            pool.terminate()
+            pool.join()
+            return -1
+        except Exception as e:
+            print("Thread pool for parsing triangles encountered an error, terminating...")
+            print(e)
+            pool.terminate()
+            pool.join()
             return -1
+        else:
+            pool.close()
+            pool.join()
 
-        triangles_path = output_path / INDICES_SUBFOLDER
-        triangles_path.mkdir(exist_ok=True)
-        triangle_index = {}
-        file_count = 0
-        cur_def = "DEF _0"
-        tri_done = False
-        while in_triangles:
-            d = {}
-            overall_min = 9999999999
-            overall_max = -1
-            def_count = 0
-            while def_count < 1000:
-                line = infile.readline()
-                while ']' not in line:
-                    nums = [int(n) for n in line.strip().split(',') if n]
-                    raw_arr += nums
-                    line = infile.readline()
-                nums = [int(n) for n in (line.split(']')[0]).strip().split(',') if n]
-                raw_arr += nums
-
-                arr = []
-                temp = []
-                for num in raw_arr:
-                    if num == -1 and temp:
-                        arr.append(temp)
-                        temp = []
-                    else:
-                        if num < overall_min:
-                            overall_min = num
-                        if num > overall_max:
-                            overall_max = num
-                        temp.append(num)
-                if temp:
-                    arr.append(temp)
-                d[cur_def.split(' ')[1]] = arr
-
-                raw_arr = []
-                while 'coordIndex' not in line:
-                    line = infile.readline()
-                    if "DEF _" in line:
-                        cur_def = " ".join(line.strip().split(' ')[:2])
-                        def_count += 1
-                    if line == '':
-                        in_triangles = False
-                        tri_done = True
-                        break
-                if tri_done:
-                    break
-                if 'coordIndex' in line:
-                    nums = [int(n) for n in (line.split('[')[1]).strip().split(',') if n]
-                    raw_arr += nums
-            save_numpy(triangles_path / f"indices_{file_count}.npy", d)
-            triangle_index[f'indices_{file_count}'] = [overall_min, overall_max]
-            file_count += 1
-        save_numpy(triangles_path / "_index.npy", triangle_index)
-        return 0
+    # _index.npy keeps the files in order regardless of which worker finished first
+    triangle_index = {name: triangle_index[name] for name in sorted(triangle_index, key=lambda n: int(n.rsplit('_')[1]))}
+    save_numpy(triangles_path / "_index.npy", triangle_index)
+    return 0
+
+
+# returns one entry per voxel size given on the command line, with its voxel sizes, image bounds and output folders.
+# The image bounds are given in voxels of the first voxel size and are rescaled for the others, whose folders are
+# suffixed with their voxel sizes.
+def get_resolutions(args, output_root: Path):
+    if not len(args.dx) == len(args.dy) == len(args.dz):
+        print("--dx, --dy and --dz must be given the same number of voxel sizes.")
+        return None
+
+    voxel_sizes = [list(sizes) for sizes in zip(args.dx, args.dy, args.dz)]
+    bounds = [args.x, args.y, args.z]
+    resolutions = []
+    for k, sizes in enumerate(voxel_sizes):
+        scale = [voxel_sizes[0][i] / sizes[i] for i in range(3)]
+        suffix = "" if k == 0 else "_" + "_".join(map(str, sizes))
+        resolutions.append({"voxel_sizes": sizes,
+                            "mins": [floor(min(bounds[i]) * scale[i]) for i in range(3)],
+                            "maxs": [ceil(max(bounds[i]) * scale[i]) for i in range(3)],
+                            "meshes": output_root / (MESH_SUBFOLDER + suffix),
+                            "image": output_root / (IMAGE_SUBFOLDER + suffix),
+                            "labels": output_root / (LABELS_SUBFOLDER + suffix),
+                            "objects": output_root / (OBJECTS_FILE + suffix + ".npy")})
+    return resolutions
 
 
 def parse_wrl(args):
@@ -181,6 +240,8 @@ def parse_wrl(args):
     if not input_path.exists():
         print("Input file does not exist.  Terminating...")
         return
+    if args.output_format == "zarr" and check_zarr() != 0:
+        return -1
 
     if not output_root.exists():
         print(f"Creating output directory: {output_root.absolute()}")
@@ -197,58 +258,170 @@ def parse_wrl(args):
         rmtree(output_root)
         output_root.mkdir(parents=True)
 
-    if args.skip_to <= 2:
-        # get voxel sizes
-        voxel_sizes = [args.dx, args.dy, args.dz]
-
-        # read wrl file and get coordinates, normals, and triangles
-        read_wrl(input_path, output_root, voxel_sizes, skip_to=args.skip_to)
-
-        print("wrl converted to index, normal, and coordinate files successfully.")
-    if args.skip_to <= 3:
-        print("Voxelizing meshes.")
-
-        # rasterize the mesh
-        rasterize_all_indices(indices_folder=(output_root / INDICES_SUBFOLDER),
-                              coords_folder=(output_root / COORDS_SUBFOLDER),
-                              output_filepath=(output_root / MESH_SUBFOLDER),
-                              threads=args.num_threads)
-        print("Voxelization successful.")
-    if args.skip_to <= 4:
-        print("Building image.")
-        # load mesh indices
-        mesh_index = read_mesh_index(output_root / MESH_SUBFOLDER)
-
-        # construct final image
-        image_mins = [min(pair) for pair in [args.x] + [args.y] + [args.z]]
-        image_maxs = [max(pair) for pair in [args.x] + [args.y] + [args.z]]
-
-        build_image(d=mesh_index,
-                    mins=image_mins,
-                    maxs=image_maxs,
-                    meshes=(output_root / MESH_SUBFOLDER),
-                    output=(output_root / IMAGE_SUBFOLDER),
-                    flips=[args.flip_x, args.flip_y, args.flip_z]
-                    )
+    resolutions = get_resolutions(args, output_root)
+    if resolutions is None:
+        return
+
+    # surfaces are read straight from the Imaris scene of .ims files instead of an exported .wrl file
+    is_ims = input_path.suffix.lower() == ".ims"
+
+    if args.labels is not None:
+        # the mesh names are known from the section index, so labels that do not fit stop the run before any work
+        layout = read_ims_layout(input_path, args.surfaces) if is_ims else load_wrl_index(input_path)
+        if layout is None or check_label_ids(layout["def_names"], args.labels) != 0:
+            return -1
+
+    if args.streaming:
+        # parse, rasterize and assemble in memory; only the final images are written
+        streamed = stream_ims(input_path, args.surfaces) if is_ims else stream_wrl(input_path)
+        if streamed is None:
+            return -1
+        coords, input_index = streamed
+        for resolution in resolutions:
+            print(f"Voxelizing meshes and building image at voxel size {resolution['voxel_sizes']}.")
+            meshes = iter_ims_meshes(input_path, input_index) if is_ims else iter_wrl_meshes(input_path, input_index)
+            if build_image_from_stream(rasterize_stream(meshes, coords, threads=args.num_threads,
+                                                        engine=args.engine, fill=args.fill,
+                                                        voxel_sizes=resolution["voxel_sizes"]),
+                                       mins=resolution["mins"],
+                                       maxs=resolution["maxs"],
+                                       output=resolution["image"],
+                                       flips=[args.flip_x, args.flip_y, args.flip_z],
+                                       total=len(input_index["def_names"]),
+                                       labels=args.labels,
+                                       labels_output=resolution["labels"],
+                                       names=input_index["def_names"],
+                                       voxel_sizes=resolution["voxel_sizes"],
+                                       objects_output=resolution["objects"],
+                                       threads=args.num_threads,
+                                       output_format=args.output_format,
+                                       chunks=args.chunks) != 0:
+                print(f"ERROR: building the image at voxel size {resolution['voxel_sizes']} failed.")
+                return -1
         print("COMPLETE")
+        return
+
+    # the parsed coordinates, normals and triangles are kept in the parse cache unless it is disabled
+    parse_root = output_root
+    parse_needed = args.skip_to <= 2
+    parse_skip_to = args.skip_to
+    cache_root = Path(args.cache_dir)
+    key = None
+    if not args.no_cache:
+        print("Fingerprinting input file")
+        key = fingerprint(input_path)
+        if is_ims:
+            key += f"_surfaces{args.surfaces}"
+        entry = lookup(cache_root, key)
+        if entry is not None:
+            print(f"Using cached parse: {entry}")
+            parse_root = entry
+            parse_needed = False
+        elif parse_needed:
+            parse_root = begin(cache_root, key, resume=parse_skip_to > 0)
+            if parse_root is None:
+                print("No interrupted parse of this input is cached, so it is parsed from the start.")
+                parse_skip_to = 0
+                parse_root = begin(cache_root, key)
+
+    overlapped = False
+    if parse_needed:
+        if args.overlap:
+            # voxelize each indices_N folder while the following ones are still being parsed
+            print("Voxelizing meshes while parsing triangles.")
+            rasterizer = RasterizeQueue(coords_folder=(parse_root / COORDS_SUBFOLDER),
+                                        outputs=[(r["voxel_sizes"], r["meshes"]) for r in resolutions],
+                                        threads=args.num_threads,
+                                        engine=args.engine,
+                                        fill=args.fill,
+                                        mask_format=args.mask_format)
+            try:
+                if is_ims:
+                    result = read_ims(input_path, parse_root, surfaces=args.surfaces, skip_to=parse_skip_to,
+                                      on_triangle_file=rasterizer.put)
+                else:
+                    result = read_wrl(input_path, parse_root, skip_to=parse_skip_to,
+                                      threads=args.num_threads, on_triangle_file=rasterizer.put)
+            except BaseException:
+                rasterizer.close(terminate=True)
+                raise
+            if rasterizer.close(terminate=(result != 0)) != 0 and result == 0:
+                print("ERROR: voxelizing meshes while parsing failed.")
+                result = -1
+            overlapped = True
+        elif is_ims:
+            # read ims file and get coordinates, normals, and triangles
+            result = read_ims(input_path, parse_root, surfaces=args.surfaces, skip_to=parse_skip_to)
+        else:
+            # read wrl file and get coordinates, normals, and triangles
+            result = read_wrl(input_path, parse_root, skip_to=parse_skip_to, threads=args.num_threads)
+        if result != 0:
+            return
+        print("input converted to index, normal, and coordinate files successfully.")
+
+        if key is not None:
+            parse_root = commit(cache_root, key)
+            if parse_root is None:
+                return -1
+            evict(cache_root, int(args.cache_size * (1 << 30)), keep=key)
+
+    for resolution in resolutions:
+        if args.skip_to <= 3 and not overlapped:
+            print(f"Voxelizing meshes at voxel size {resolution['voxel_sizes']}.")
+
+            # rasterize the mesh
+            if rasterize_all_indices(indices_folder=(parse_root / INDICES_SUBFOLDER),
+                                     coords_folder=(parse_root / COORDS_SUBFOLDER),
+                                     output_filepath=resolution["meshes"],
+                                     threads=args.num_threads,
+                                     voxel_sizes=resolution["voxel_sizes"],
+                                     engine=args.engine,
+                                     fill=args.fill,
+                                     mask_format=args.mask_format) != 0:
+                return -1
+            print("Voxelization successful.")
+        if args.skip_to <= 4:
+            print(f"Building image at voxel size {resolution['voxel_sizes']}.")
+            # load mesh indices
+            mesh_index = read_mesh_index(resolution["meshes"])
+
+            # construct final image
+            if build_image(d=mesh_index,
+                           mins=resolution["mins"],
+                           maxs=resolution["maxs"],
+                           meshes=resolution["meshes"],
+                           output=resolution["image"],
+                           flips=[args.flip_x, args.flip_y, args.flip_z],
+                           labels=args.labels,
+                           labels_output=resolution["labels"],
+                           voxel_sizes=resolution["voxel_sizes"],
+                           objects_output=resolution["objects"],
+                           slab_depth=args.slab_depth,
+                           threads=args.num_threads,
+                           output_format=args.output_format,
+                           chunks=args.chunks
+                           ) != 0:
+                print(f"ERROR: building the image at voxel size {resolution['voxel_sizes']} failed.")
+                return -1
+    print("COMPLETE")
 
 if __name__ == '__main__':
     parser = ArgumentParser()
 
     parser.add_argument('--input', '-i', type=str, required=True,
-                        help="Path to input .wrl file")
+                        help="Path to input .wrl file, or .ims file to read surfaces directly from the Imaris scene")
     parser.add_argument('--output', '-o', type=str, required=True,
                         help="Path to output directory.  EXISTING CONTENTS IN THE OUTPUT DIRECTORY WILL BE DELETED.  Non-existant directories will be created.")
     # parser.add_argument('--force_restart', '-fr', action='store_true',
     #                     help="Since the process may take long, the program will automatically continue from the last saved point if it crashed.  Include this argument to force a restart.")
     parser.add_argument('--num_threads', '-n', type=int, default=1,
-                        help="Number of threads used for assembling final output image.")
-    parser.add_argument('--dx', '-dx', type=float, required=True,
-                        help="Voxel size in x-axis")
-    parser.add_argument('--dy', '-dy', type=float, required=True,
-                        help="Voxel size in y-axis")
-    parser.add_argument('--dz', '-dz', type=float, required=True,
-                        help="Voxel size in z-axis")
+                        help="Number of processes used for parsing triangles and voxelizing meshes.")
+    parser.add_argument('--dx', '-dx', nargs='+', type=float, required=True,
+                        help="Voxel size in x-axis.  Several values build one image per voxel size.")
+    parser.add_argument('--dy', '-dy', nargs='+', type=float, required=True,
+                        help="Voxel size in y-axis.  Several values build one image per voxel size.")
+    parser.add_argument('--dz', '-dz', nargs='+', type=float, required=True,
+                        help="Voxel size in z-axis.  Several values build one image per voxel size.")
     parser.add_argument('--x', '-x', nargs=2, type=int, required=True,
                         help="Minimum and maximum of the x-axis.")
     parser.add_argument('--y', '-y', nargs=2, type=int, required=True,
@@ -263,4 +436,30 @@ if __name__ == '__main__':
                         help="Flip images along y axis")
     parser.add_argument("--flip_z", '-fz', action='store_true',
                         help="Flip images along z axis")
+    parser.add_argument("--surfaces", '-sf', type=int, default=0,
+                        help="Index k of the Surfaces<k> object to read from an .ims input file.")
+    parser.add_argument("--cache_dir", '-cd', type=str, default=str(DEFAULT_CACHE_DIR),
+                        help="Directory where parsed input files are cached between runs.")
+    parser.add_argument("--cache_size", '-cs', type=float, default=100,
+                        help="Maximum size of the parse cache in GB.  The least recently used parses are deleted first.")
+    parser.add_argument("--no_cache", '-nc', action='store_true',
+                        help="Parse into the output directory without reading or writing the parse cache.")
+    parser.add_argument("--overlap", '-ov', action='store_true',
+                        help="Voxelize each batch of triangles as soon as it is parsed instead of after the whole file.")
+    parser.add_argument("--streaming", '-s', action='store_true',
+                        help="Parse, voxelize and assemble meshes in memory without writing intermediate files.  Interrupted runs cannot be resumed with --skip_to.")
+    parser.add_argument("--engine", '-e', type=str, default="open3d", choices=ENGINES,
+                        help="Voxelizer used for each mesh.  open3d marks the surface voxels as open3d's voxel grid does and fills holes in 3D; native fills the solid directly from the triangles.")
+    parser.add_argument("--fill", '-fl', type=str, default="3d", choices=FILLS,
+                        help="How the open3d engine fills the inside of each mesh.  3d fills the whole bounding box at once; slice fills each z-slice on its own, using far less memory for large, thin or elongated meshes.")
+    parser.add_argument("--labels", '-lb', type=str, default=None, choices=list(LABEL_TYPES.keys()),
+                        help="Also save a label image of this type, in which each mesh has its own id, with a csv file mapping mesh names to ids.")
+    parser.add_argument("--mask_format", '-mf', type=str, default=DEFAULT_MASK_FORMAT, choices=MASK_FORMATS,
+                        help="How each mesh mask is saved in np_meshes.  dense uses one byte per voxel; packbits one bit per voxel; rle the runs of filled voxels along z.")
+    parser.add_argument("--slab_depth", '-sd', type=int, default=0,
+                        help="Assemble and save the image this many z-slices at a time instead of all at once, so memory use is bound by one slab.  0 assembles the whole image.")
+    parser.add_argument("--output_format", '-of', type=str, default="tif", choices=OUTPUT_FORMATS,
+                        help="tif saves the image as one .tif file per z-slice; zarr as a chunked, compressed OME-Zarr store.")
+    parser.add_argument("--chunks", '-ch', type=int, nargs=3, default=DEFAULT_CHUNKS,
+                        help="Chunk shape (z, y, x) of the OME-Zarr store with --output_format zarr.")
     parse_wrl(parser.parse_args())
@@ -1,110 +1,562 @@
-from numpy import stack, zeros, asarray, ndarray, concatenate
-from utils import load_numpy, load_multi_numpy, save_numpy
-from open3d import geometry, utility
-from scipy.ndimage import binary_fill_holes
+from numpy import zeros, ndarray, asarray, concatenate, floor_divide, unique, float64, int64
+from numpy import diff, prod, minimum, maximum, argsort, corrcoef, savetxt, load, empty, float32, arange, cumsum
+from numpy import searchsorted, where, issubdtype, integer
+from utils import load_numpy, load_faces, share_array, attach_shared_array, new_shared_array
+from scipy.ndimage import binary_fill_holes, label
 from pathlib import Path
-from multiprocessing import Pool
+from solid_voxelizer import voxelize_solid, voxelize_batch, mark_surface
+from mask_format import encode_mask, write_mask_record, recover_mask_names, DEFAULT_MASK_FORMAT, MASKS_FILE
+from object_stats import mask_stats, mesh_area
+from multiprocessing import Pool, Process, Queue
+from queue import Full
 from tqdm import tqdm
+from time import perf_counter
+from hashlib import blake2b
+from os import fsync
 
 
-def rasterize_single_mesh(indices: ndarray, coordinates, coords_offset):
-    # create mesh
-    mesh = geometry.TriangleMesh()
+# open3d marks the voxels open3d's VoxelGrid.create_from_triangle_mesh gives for the surface and fills them with
+# binary_fill_holes; native fills the solid directly from the triangles
+ENGINES = ["open3d", "native"]
+# 3d fills the whole bounding box at once; slice fills each z-slice on its own
+FILLS = ["3d", "slice"]
 
-    if coords_offset != 0:
-        indices -= coords_offset
+# estimated cost of a mesh in microseconds, used to balance rasterize_all_indices tasks.  Triangles are voxelized one
+# at a time and the whole bounding box is filled, so both are counted, on top of a fixed cost for setting up and saving
+# each mesh.  Check the weights against the measured task times in TIMINGS_FILE.
+TRIANGLE_COST = 1.0
+VOXEL_COST = 0.03
+MESH_COST = 1500.0
+TINY_MESH_COST = 40.0  # whole cost of a mesh rasterized by rasterize_tiny_meshes
+TASKS_PER_THREAD = 4  # tasks planned per process, so the last, smallest tasks even out the finishing times
+TIMINGS_FILE = "_timings.csv"
+# identifies the run whose masks are in a meshes folder, see run_signature
+RUN_FILE = "_run.txt"
+# meshes whose bounding box has at most this many voxels are rasterized by rasterize_tiny_meshes, many in one call,
+# without building open3d objects
+TINY_MESH_VOXELS = 32 ** 3
 
-    mesh.vertices = utility.Vector3dVector(coordinates)
-    mesh.triangles = utility.Vector3iVector(indices)
-    mesh.remove_unreferenced_vertices()
 
-    # get bounds
-    mins = mesh.get_min_bound()
-    maxs = mesh.get_max_bound()
+# fills the closed contours of each z-slice of image in place.  Unlike binary_fill_holes on the whole box, only one
+# slice is worked on at a time, and the background of each slice is labelled in one pass instead of being filled by
+# repeated dilation.  The result is the same as binary_fill_holes on each slice.
+def fill_slices(image: ndarray):
+    for z in range(image.shape[2]):
+        labels, n_labels = label(~image[:, :, z])
+        # background regions touching the edge of the slice are outside the mesh; label 0 is the mesh itself
+        outside = zeros(n_labels + 1, dtype=bool)
+        outside[labels[0]] = True
+        outside[labels[-1]] = True
+        outside[labels[:, 0]] = True
+        outside[labels[:, -1]] = True
+        outside[0] = False
+        image[:, :, z] = ~outside[labels]
+    return image
 
-    # voxelize mesh
-    voxel_grid = geometry.VoxelGrid.create_from_triangle_mesh(mesh, voxel_size=1)
 
-    # visualization.draw_geometries([voxel_grid])
+# rasterizes meshes whose faces, indexing coordinates directly, are concatenated in faces, mesh m being
+# faces[face_offsets[m]:face_offsets[m + 1]], in one compiled call.  mins and maxs are the corners of each mesh.  The
+# masks are the same as rasterize_single_mesh gives with the same engine and fill, but no open3d objects are built,
+# which is most of the cost of meshes of a few voxels.  Returns the list of masks.
+def rasterize_tiny_meshes(faces: ndarray, face_offsets: ndarray, coordinates, mins: ndarray, maxs: ndarray,
+                          engine: str = "open3d", fill: str = "3d"):
+    shapes = (maxs - mins + 1).astype(int64)
+    mask_offsets = zeros(len(shapes) + 1, dtype=int64)
+    mask_offsets[1:] = cumsum(prod(shapes, axis=1))
+    masks = zeros(mask_offsets[-1], dtype=bool)
+    voxelize_batch(coordinates, faces.astype(int64, copy=False), face_offsets, mins.astype(float64), shapes,
+                   mask_offsets, masks, engine == "native", fill == "slice")
+    return [masks[mask_offsets[m]:mask_offsets[m + 1]].reshape(shapes[m]) for m in range(len(shapes))]
 
-    voxel_indices = stack([voxel.grid_index for voxel in voxel_grid.get_voxels()])
 
-    # convert to binary mask
-    image = zeros(tuple([int(maxs[i] - mins[i] + 1) for i in range(len(mins))]), dtype=bool)
+# engine is one of ENGINES and fill one of FILLS.  The native engine fills the mesh itself, so fill only applies to
+# the open3d engine.
+def rasterize_single_mesh(indices: ndarray, coordinates, coords_offset, engine: str = "open3d", fill: str = "3d"):
+    # indices may be a read-only slice of a memory-mapped face array; shifting it also makes the copy open3d needs
+    indices = indices - coords_offset
+
+    vertices = coordinates[indices.ravel()]
+    mins = vertices.min(axis=0).astype(float64)
+    maxs = vertices.max(axis=0).astype(float64)
+    if prod(maxs - mins + 1) <= TINY_MESH_VOXELS:
+        image = rasterize_tiny_meshes(indices, asarray([0, len(indices)]), coordinates, mins[None], maxs[None],
+                                      engine, fill)[0]
+        return image, mins, maxs
 
-    for index in voxel_indices:
-        image[index[0], index[1], index[2]] = True
+    if engine == "native":
+        return voxelize_solid(indices, coordinates)
+
+    # the surface voxels are marked straight into the mask, by the same triangle-voxel overlap test open3d's voxel
+    # grid uses, instead of building open3d objects and reading the grid back out of them
+    used, faces = unique(indices, return_inverse=True)
+    image = zeros(tuple([int(maxs[i] - mins[i] + 1) for i in range(len(mins))]), dtype=bool)
+    mark_surface(coordinates[used].astype(float64) - mins, faces.reshape(-1, 3), image)
 
-    image = binary_fill_holes(image)
+    if fill == "slice":
+        image = fill_slices(image)
+    else:
+        image = binary_fill_holes(image)
     return image, mins, maxs
 
 
-# input_path should be a path to a numpy file, output_path should be a directory
+# input_path should be an indices_N folder written by utils.save_faces, output_path should be a directory
 # coords is a list containing coordinates.  coords_offset is the index of the first value in coords.
-def rasterize_file(input_path: Path, coords: list[list[float]], coords_offset: int, output_path: Path):
-    print("rasterizing file", str(input_path.absolute), len(coords), coords_offset, str(output_path.absolute))
-    index_file = load_numpy(input_path, True)
+# Only the meshes at positions meshes are rasterized if given.  Their masks, encoded in mask_format, one of
+# mask_format.MASK_FORMATS, are appended with their bounds, statistics and surface area to the container masks_name.
+# The area is measured on physical, the same coordinates as coords in the units of the input file, or on coords
+# itself if physical is not given.
+def rasterize_file(input_path: Path, coords: list[list[float]], coords_offset: int, output_path: Path,
+                   engine: str = "open3d", fill: str = "3d", meshes: list = None, masks_name: str = MASKS_FILE,
+                   mask_format: str = DEFAULT_MASK_FORMAT, physical: ndarray = None):
+    names, faces, offsets = load_faces(input_path)
     output_path.mkdir(exist_ok=True, parents=True)
-    index_path = (output_path / "index.txt")
-    index_path.touch(exist_ok=True)
+    physical = coords if physical is None else physical
 
-    with index_path.open('w') as index:
-        for key in index_file.keys():
-            image, mins, maxs = rasterize_single_mesh(asarray(index_file[key]), coords, coords_offset)
-            index.write(key + ", " + ", ".join(map(str, concatenate((mins, maxs)))) + "\n")
-            save_numpy(output_path / key, image)
+    meshes = arange(len(names)) if meshes is None else asarray(sorted(meshes), dtype=int64)
+    # empty meshes have no mask
+    meshes = meshes[offsets[meshes + 1] > offsets[meshes]]
+    tiny = zeros(len(meshes), dtype=bool)
+    if len(meshes):
+        mins, maxs = mesh_bounds(faces, offsets, meshes, coords, coords_offset)
+        tiny = prod(maxs - mins + 1, axis=1) <= TINY_MESH_VOXELS
 
-    return
+    with (output_path / masks_name).open('ab') as masks:
+        if tiny.any():
+            # the tiny meshes are rasterized together, with their faces in one array
+            tiny_offsets = zeros(tiny.sum() + 1, dtype=int64)
+            tiny_offsets[1:] = cumsum(offsets[meshes[tiny] + 1] - offsets[meshes[tiny]])
+            tiny_faces = concatenate([faces[offsets[i]:offsets[i + 1]] for i in meshes[tiny]]) - coords_offset
+            images = rasterize_tiny_meshes(tiny_faces, tiny_offsets, coords, mins[tiny], maxs[tiny], engine, fill)
+            for i, image, mesh_mins, mesh_maxs in zip(meshes[tiny], images, mins[tiny], maxs[tiny]):
+                write_mask_record(masks, names[i], mesh_mins, mesh_maxs, mask_format, encode_mask(image, mask_format),
+                                  mask_stats(image, mesh_mins),
+                                  mesh_area(faces[offsets[i]:offsets[i + 1]] - coords_offset, physical))
 
+        for i in meshes[~tiny]:
+            # zero-copy slice of the memory-mapped face array
+            mesh_faces = faces[offsets[i]:offsets[i + 1]]
+            # only the mesh's own vertices are passed on, so the cost of a mesh does not depend on its neighbours
+            lo = int(mesh_faces.min())
+            hi = int(mesh_faces.max())
+            image, mins, maxs = rasterize_single_mesh(mesh_faces, coords[lo - coords_offset:hi - coords_offset + 1], lo,
+                                                      engine, fill)
+            write_mask_record(masks, names[i], mins, maxs, mask_format, encode_mask(image, mask_format),
+                              mask_stats(image, mins), mesh_area(mesh_faces - coords_offset, physical))
+        fsync(masks.fileno())
 
-def splitter(args: tuple):
-    rasterize_file(*args)
     return
 
 
-def rasterize_all_indices(indices_folder: Path, coords_folder: Path, output_filepath: Path, threads=8):
-    print("Loading coordinates")
-    coords_filepaths = sorted(coords_folder.glob('*.npy'), key=lambda path: int(path.stem.split('.')[0].rsplit('_')[1]))
-    coords = load_multi_numpy(coords_filepaths)
+# minimum and maximum corners of the nonempty meshes at positions meshes, in increasing order, of faces and offsets as
+# written by utils.save_faces
+def mesh_bounds(faces, offsets: ndarray, meshes: ndarray, coords, coords_offset: int):
+    first, last = int(meshes[0]), int(meshes[-1]) + 1
+    span = arange(first, last)
+    span = span[offsets[first + 1:last + 1] > offsets[first:last]]
+    # vertices of every face corner, reduced mesh by mesh
+    vertices = coords[asarray(faces[offsets[first]:offsets[last]]).ravel() - coords_offset]
+    starts = 3 * (offsets[span] - offsets[first])
+    rows = searchsorted(span, meshes)
+    return minimum.reduceat(vertices, starts)[rows], maximum.reduceat(vertices, starts)[rows]
 
-    print("Loading indices")
-    indices_files = list(indices_folder.iterdir())
-    indices_index = indices_files[-1]  # grab the '_index.npy' file
-    indices_files = indices_files[:-1]
 
-    index_offsets = load_numpy(indices_index, True)
+# estimated cost of each mesh of the indices_N folder input_path, from its triangle count and bounding box volume
+def mesh_costs(input_path: Path, coords, coords_offset: int):
+    names, faces, offsets = load_faces(input_path)
+    counts = diff(offsets)
+    nonempty = counts > 0
+    costs = TRIANGLE_COST * counts.astype(float64) + MESH_COST * nonempty
+    if nonempty.any():
+        mins, maxs = mesh_bounds(faces, offsets, arange(len(counts))[nonempty], coords, coords_offset)
+        boxes = prod((maxs - mins + 1).astype(float64), axis=1)
+        costs[nonempty] = where(boxes <= TINY_MESH_VOXELS, TINY_MESH_COST, costs[nonempty] + VOXEL_COST * boxes)
+    return costs
 
-    # make parameters
-    params = []
 
+# groups the meshes of all indices_N folders into tasks of roughly equal estimated cost.  Meshes costing more than
+# the target get a task of their own; the rest are packed in file order until a task reaches the target.  Returns
+# (cost, parts) tuples, most expensive first, where parts lists (folder, mesh positions) pairs.  Meshes named in done,
+# a dict of folder name to mesh names, are left out.  coords are quantized with voxel_sizes if given.
+def plan_tasks(indices_files: list, index_offsets: dict, coords, threads: int, done: dict = None,
+               voxel_sizes: list = None):
+    costs = []
     for file in indices_files:
-        temp_input_path = file
-        temp_offsets = index_offsets[file.stem]
-        temp_coords = coords[int(temp_offsets[0]):int(temp_offsets[1]) + 1]
-        params.append(tuple([temp_input_path, temp_coords, int(temp_offsets[0]), output_filepath / file.stem.split('.')[0]]))
+        lo, hi = int(index_offsets[file.name][0]), int(index_offsets[file.name][1])
+        file_coords = coords[lo:hi + 1] if voxel_sizes is None else quantize(coords[lo:hi + 1], voxel_sizes)
+        file_costs = mesh_costs(file, file_coords, lo)
+        if done and done.get(file.name):
+            names = load(file / "names.npy")
+            file_costs[[name in done[file.name] for name in names]] = 0.0
+        costs.append(file_costs)
+    total = sum(float(file_costs.sum()) for file_costs in costs)
+    target = total / max(threads * TASKS_PER_THREAD, 1)
 
-    if threads == 1:
-        list(tqdm(map(splitter, params), total=len(indices_files)))
+    tasks = []
+    batch = []
+    batch_cost = 0.0
+    for file, file_costs in zip(indices_files, costs):
+        small = []
+        for i, cost in enumerate(file_costs):
+            # empty meshes have no mask, and finished ones already have theirs
+            if cost == 0:
+                continue
+            if cost >= target:
+                tasks.append((float(cost), [(file, [i])]))
+                continue
+            small.append(i)
+            batch_cost += cost
+            if batch_cost >= target:
+                batch.append((file, small))
+                tasks.append((batch_cost, batch))
+                small = []
+                batch = []
+                batch_cost = 0.0
+        if small:
+            batch.append((file, small))
+    if batch:
+        tasks.append((batch_cost, batch))
+
+    tasks.sort(key=lambda task: task[0], reverse=True)
+    return tasks
+
+
+# identifies the meshes, voxel sizes, engine and fill of a run of rasterize_all_indices.  The parsed meshes are
+# identified by their coordinate bounds and the modification times of their face offsets.
+def run_signature(indices_files: list, index_offsets: dict, voxel_sizes, engine: str, fill: str):
+    h = blake2b(f"{voxel_sizes}:{engine}:{fill}".encode('utf-8'), digest_size=16)
+    for file in indices_files:
+        bounds = index_offsets[file.name]
+        h.update(f";{file.name}:{int(bounds[0])}:{int(bounds[1])}:{(file / 'offsets.npy').stat().st_mtime_ns}"
+                 .encode('utf-8'))
+    return h.hexdigest()
+
+
+# prepares output_filepath for a run with the given signature.  If an interrupted run with the same signature wrote
+# it, its complete mask records are kept, and the names of their meshes are returned as a dict of folder name to
+# names.  Otherwise the masks of any earlier run are deleted.
+def resume_masks(indices_files: list, output_filepath: Path, signature: str):
+    run_file = output_filepath / RUN_FILE
+    resume = run_file.is_file() and run_file.read_text().strip() == signature
+    done = {}
+    for file in indices_files:
+        folder = output_filepath / file.name
+        if resume:
+            names = set()
+            for masks_file in folder.glob("masks*.bin"):
+                names.update(recover_mask_names(masks_file))
+            if names:
+                done[file.name] = names
+        else:
+            for stale in [*folder.glob("masks*.bin"), *folder.glob("index*.txt")]:
+                stale.unlink()
+    output_filepath.mkdir(parents=True, exist_ok=True)
+    run_file.write_text(signature + "\n")
+    return done
+
+
+# rasterizes every part of a planned task, whose meshes use coordinates lo to hi, writing its masks to
+# masks_<task_id>.bin in each output folder.  Returns the task id, number of meshes and seconds taken.
+def rasterize_task(args: tuple):
+    task_id, parts, lo, hi, output_filepath = args
+    start = perf_counter()
+    physical = _worker_coords[lo:hi + 1]
+    coords = physical if _worker_voxel_sizes is None else quantize(physical, _worker_voxel_sizes)
+    for input_path, meshes in parts:
+        rasterize_file(input_path, coords, lo, output_filepath / input_path.name,
+                       _worker_engine, _worker_fill, meshes=meshes, masks_name=f"masks_{task_id}.bin",
+                       mask_format=_worker_mask_format, physical=physical)
+    return task_id, sum(len(meshes) for _, meshes in parts), perf_counter() - start
+
+
+# writes the estimated cost and measured time of each task to TIMINGS_FILE and prints how well they agree
+def report_timings(tasks: list, timings: list, output_filepath: Path):
+    if not timings:
+        return
+    rows = asarray([[task_id, n_meshes, tasks[task_id][0], seconds] for task_id, n_meshes, seconds in timings])
+    rows = rows[argsort(rows[:, 0])]
+    savetxt(output_filepath / TIMINGS_FILE, rows, delimiter=",", fmt=["%d", "%d", "%.1f", "%.4f"],
+            header="task,meshes,estimated_cost,seconds", comments="")
+    seconds = rows[:, 3]
+    print(f"{len(rows)} tasks, slowest {seconds.max():.2f} s, mean {seconds.mean():.2f} s.")
+    if len(rows) > 1 and rows[:, 2].std() > 0 and seconds.std() > 0:
+        print(f"Correlation of estimated cost and task time: {corrcoef(rows[:, 2], seconds)[0, 1]:.3f}")
+    print(f"Task timings written to {output_filepath / TIMINGS_FILE}")
+
+
+# coordinates, in the units of the input file, the voxel sizes they are quantized with, and the engine, fill and mask
+# format shared with the worker processes of rasterize_stream and rasterize_all_indices
+_worker_coords = None
+_worker_memory = None
+_worker_voxel_sizes = None
+_worker_engine = "open3d"
+_worker_fill = "3d"
+_worker_mask_format = DEFAULT_MASK_FORMAT
+
+
+# coords is either the coordinates, when rasterizing in this process, or the spec of coordinates placed in shared
+# memory with utils.share_array, which every worker views without a copy.  Each worker quantizes only the coordinates
+# of the meshes it rasterizes, with voxel_sizes if given.
+def init_worker(coords, engine="open3d", fill="3d", mask_format=DEFAULT_MASK_FORMAT, voxel_sizes=None):
+    global _worker_coords, _worker_memory, _worker_engine, _worker_fill, _worker_mask_format, _worker_voxel_sizes
+    if isinstance(coords, ndarray):
+        _worker_coords = coords
     else:
-        pool = Pool(processes=threads)
+        _worker_memory, _worker_coords = attach_shared_array(coords)
+    _worker_engine = engine
+    _worker_fill = fill
+    _worker_mask_format = mask_format
+    _worker_voxel_sizes = voxel_sizes
+
+
+def rasterize_stream_mesh(mesh: tuple):
+    name, faces = mesh
+    if len(faces) == 0:
+        return None
+    lo = int(faces.min())
+    hi = int(faces.max())
+    physical = _worker_coords[lo:hi + 1]
+    coords = physical if _worker_voxel_sizes is None else quantize(physical, _worker_voxel_sizes)
+    image, mins, maxs = rasterize_single_mesh(faces, coords, lo, _worker_engine, _worker_fill)
+    return name, image, mins, maxs, mesh_area(faces - lo, physical)
+
+
+# rasterizes (name, faces) tuples as they are produced, yielding (name, mask, mins, maxs, surface area) for each mesh
+# in whatever order the workers finish.  coords are quantized with voxel_sizes if given, and the area is in the units
+# of coords.  Nothing is written to disk.
+def rasterize_stream(meshes, coords, threads=8, engine="open3d", fill="3d", voxel_sizes: list = None):
+    if threads == 1:
+        init_worker(coords, engine, fill, voxel_sizes=voxel_sizes)
+        results = map(rasterize_stream_mesh, meshes)
+        yield from (result for result in results if result is not None)
+        return
+
+    # the workers view the coordinates in shared memory, so this copy is no longer needed
+    memory, spec = share_array(coords)
+    del coords
+    pool = Pool(processes=threads, initializer=init_worker, initargs=(spec, engine, fill, DEFAULT_MASK_FORMAT,
+                                                                      voxel_sizes))
+    try:
+        for result in pool.imap_unordered(rasterize_stream_mesh, meshes, chunksize=16):
+            if result is not None:
+                yield result
+    except KeyboardInterrupt:
+        print("KeyboardInterrupt detected, terminating thread pool...")
+        raise
+    except Exception:
+        print("Thread pool for rasterizing meshes encountered an error, terminating...")
+        raise
+    finally:
+        # every task has finished by the time imap_unordered is exhausted
+        pool.terminate()
+        pool.join()
+        memory.close()
+        memory.unlink()
+
+
+# converts physical coordinates to voxel indices
+def quantize(coords: ndarray, voxel_sizes: list):
+    return floor_divide(coords, asarray(voxel_sizes, dtype=float64)).astype(int64)
+
+
+def coords_filepaths(coords_folder: Path):
+    return sorted(coords_folder.glob('*.npy'), key=lambda path: int(path.stem.split('.')[0].rsplit('_')[1]))
+
+
+# shape and dtype of the array load_coords returns
+def coords_layout(coords_folder: Path, voxel_sizes: list = None):
+    blocks = [load(path, mmap_mode='r') for path in coords_filepaths(coords_folder)]
+    coords_dtype = int64 if voxel_sizes is not None else (blocks[0].dtype if blocks else float32)
+    return (sum(len(block) for block in blocks), 3), coords_dtype
+
+
+# coordinate files written by versions that quantized while parsing hold integer voxel indices, which would be
+# quantized a second time.  Returns -1 for such files.
+def check_coords(coords_folder: Path):
+    for path in coords_filepaths(coords_folder):
+        if issubdtype(load(path, mmap_mode='r').dtype, integer):
+            print(f"ERROR: {path.name} was parsed by an earlier version and holds quantized coordinates.  "
+                  f"Rerun from --skip_to 0.")
+            return -1
+    return 0
+
+
+# loads and concatenates the coordinate files, quantized with voxel_sizes if given.  The files are converted one at a
+# time into out, or a new array, so no other copy of all coordinates is made.
+def load_coords(coords_folder: Path, voxel_sizes: list = None, out: ndarray = None):
+    if out is None:
+        out = empty(*coords_layout(coords_folder, voxel_sizes))
+    start = 0
+    for path in coords_filepaths(coords_folder):
+        block = load(path, mmap_mode='r')
+        out[start:start + len(block)] = block if voxel_sizes is None else quantize(block, voxel_sizes)
+        start += len(block)
+    return out
+
+
+# a worker whose folder fails reports it and exits with code 1, which RasterizeQueue.close checks
+def rasterize_worker(queue):
+    while True:
+        args = queue.get()
+        if args is None:
+            return
         try:
-            # need to convert to list so the tqdm iterator is consumed; otherwise progress bar doesn't update.
-            list(tqdm(pool.imap_unordered(splitter, params), total=len(indices_files)))
-        except KeyboardInterrupt:
-            print("KeyboardInterrupt detected, terminating thread pool...")
-            pool.terminate()
-            pool.join()
-        except Exception as e:  # this one ideally should never occur...
-            print("Thread pool for aligning large images encountered an error, terminating...")
-            print(e)
-            pool.terminate()
-            pool.join()
+            rasterize_file(*args)
+        except Exception as e:
+            print(f"ERROR: voxelizing {args[0]} failed: {e}")
+            raise SystemExit(1)
+
+
+class RasterizeQueue:
+    """
+    Rasterization processes fed through a bounded queue, so each indices_N folder can be voxelized as soon as the
+    parser has written it.  put() blocks while queue_size tasks are waiting, which keeps memory flat when parsing
+    outpaces rasterization.  outputs is a list of (voxel_sizes, output_filepath), each folder being rasterized once per
+    entry.
+    """
+
+    def __init__(self, coords_folder: Path, outputs: list, threads: int = 8, queue_size: int = None,
+                 engine: str = "open3d", fill: str = "3d", mask_format: str = DEFAULT_MASK_FORMAT):
+        self.coords_folder = coords_folder
+        self.outputs = outputs
+        self.engine = engine
+        self.fill = fill
+        self.mask_format = mask_format
+        self.coords = None
+        self.queue = Queue(maxsize=queue_size or 2 * threads)
+        self.workers = [Process(target=rasterize_worker, args=(self.queue,)) for _ in range(threads)]
+        for worker in self.workers:
+            worker.start()
+
+    # queues the indices_N folder input_path, whose coordinate indices lie in bounds = [min, max]
+    def put(self, input_path: Path, bounds: list):
+        if self.coords is None:
+            # the coordinates are complete on disk before the first triangle file is parsed
+            print("Loading coordinates")
+            self.coords = load_coords(self.coords_folder)
+        coords = self.coords[int(bounds[0]):int(bounds[1]) + 1]
+        for voxel_sizes, output_filepath in self.outputs:
+            # the folder is rasterized from scratch, and rasterize_file appends to its container
+            for stale in (output_filepath / input_path.name).glob("masks*.bin"):
+                stale.unlink()
+            args = tuple([input_path, quantize(coords, voxel_sizes), int(bounds[0]), output_filepath / input_path.name,
+                          self.engine, self.fill, None, MASKS_FILE, self.mask_format, coords])
+            if not self.put_item(args):
+                raise RuntimeError("All rasterization processes have exited.")
+
+    # puts item on the queue, waiting while it is full as long as a worker is alive.  Returns False if every worker
+    # has exited, so nothing would ever take it.
+    def put_item(self, item):
+        while True:
+            try:
+                self.queue.put(item, timeout=1)
+                return True
+            except Full:
+                if not any(worker.is_alive() for worker in self.workers):
+                    return False
+
+    # waits for the queued folders to finish.  With terminate=True, queued work is abandoned instead.  Returns -1 if
+    # work was abandoned or a worker failed, so some folders were not voxelized.
+    def close(self, terminate: bool = False):
+        if terminate:
+            for worker in self.workers:
+                worker.terminate()
         else:
-            pool.close()
-            pool.join()
+            for _ in self.workers:
+                if not self.put_item(None):
+                    break
+        for worker in self.workers:
+            worker.join()
+        if terminate or any(worker.exitcode != 0 for worker in self.workers):
+            # nothing will read what is left in the queue, which this process would otherwise wait to flush at exit
+            self.queue.cancel_join_thread()
+            return -1
+        return 0
 
-    print("COMPLETE")
-    return
+
+# coordinates are quantized with voxel_sizes if given, otherwise they are used as stored.  They are loaded unquantized,
+# so the surface area of each mesh is measured in the units of the input file.  Returns -1 if the coordinates cannot
+# be used, or if the workers were interrupted or failed.
+def rasterize_all_indices(indices_folder: Path, coords_folder: Path, output_filepath: Path, threads=8,
+                          voxel_sizes: list = None, engine: str = "open3d", fill: str = "3d",
+                          mask_format: str = DEFAULT_MASK_FORMAT):
+    if voxel_sizes is not None and check_coords(coords_folder) != 0:
+        return -1
+    print("Loading coordinates")
+    memory = None
+    if threads == 1:
+        coords = load_coords(coords_folder)
+    else:
+        # the coordinates are placed in shared memory once, where every worker views them without a copy, instead of
+        # being sent to the workers with every task
+        memory, spec, coords = new_shared_array(*coords_layout(coords_folder))
+    # the shared memory is unlinked however the run ends, so an error while loading or planning does not leave it
+    # behind in /dev/shm
+    try:
+        if memory is not None:
+            load_coords(coords_folder, out=coords)
+
+        print("Loading indices")
+        index_offsets = load_numpy(indices_folder / "_index.npy", True)
+        indices_files = [indices_folder / name for name in index_offsets.keys()]
+
+        done = resume_masks(indices_files, output_filepath, run_signature(indices_files, index_offsets, voxel_sizes,
+                                                                          engine, fill))
+        if done:
+            finished = sum(len(names) for names in done.values())
+            print(f"Resuming: {finished} meshes were voxelized by an earlier run and are skipped")
+
+        print("Planning tasks")
+        tasks = plan_tasks(indices_files, index_offsets, coords, threads, done, voxel_sizes)
+
+        # make parameters
+        params = []
+
+        for task_id, (cost, parts) in enumerate(tasks):
+            lo = min(int(index_offsets[file.name][0]) for file, _ in parts)
+            hi = max(int(index_offsets[file.name][1]) for file, _ in parts)
+            params.append(tuple([task_id, parts, lo, hi, output_filepath]))
+
+        timings = []
+        if threads == 1:
+            init_worker(coords, engine, fill, mask_format, voxel_sizes)
+            timings = list(tqdm(map(rasterize_task, params), total=len(params)))
+        else:
+            # the shared memory cannot be closed while this process still views it
+            del coords
+            pool = Pool(processes=threads, initializer=init_worker, initargs=(spec, engine, fill, mask_format,
+                                                                              voxel_sizes))
+            try:
+                # need to convert to list so the tqdm iterator is consumed; otherwise progress bar doesn't update.
+                # chunksize 1 keeps the largest-first order of the tasks.
+                timings = list(tqdm(pool.imap_unordered(rasterize_task, params, chunksize=1), total=len(params)))
+            except KeyboardInterrupt:
+                print("KeyboardInterrupt detected, terminating thread pool...")
+                pool.terminate()
+                pool.join()
+                return -1
+            except Exception as e:  # this one ideally should never occur...
+                print("Thread pool for voxelizing meshes encountered an error, terminating...")
+                print(e)
+                pool.terminate()
+                pool.join()
+                return -1
+            else:
+                pool.close()
+                pool.join()
+
+        report_timings(tasks, timings, output_filepath)
+        print("COMPLETE")
+        return 0
+    finally:
+        if memory is not None:
+            coords = None
+            # views held by the traceback of an error can keep the block mapped, which close() refuses, but the
+            # unlinked block is still freed when this process exits
+            try:
+                memory.close()
+            except BufferError:
+                pass
+            memory.unlink()
 
 
 if __name__ == '__main__':
@@ -113,5 +565,8 @@ if __name__ == '__main__':
     coords_filepath = sorted(coords_folder.glob('*.npy'), key=lambda path: int(path.stem.split('.')[0].rsplit('_')[1]))
 
     output_filepath = Path(r'E:\Aidan\plaques_extracted\meshes')
+    # the coordinates are in the units of the input file, so the voxel sizes, as --dx, --dy and --dz of parse_wrl, must
+    # be given
+    dx, dy, dz = 1.0, 1.0, 1.0
 
-    rasterize_all_indices(indices_filepath, coords_folder, output_filepath, 48)
+    rasterize_all_indices(indices_filepath, coords_folder, output_filepath, 48, voxel_sizes=[dx, dy, dz])
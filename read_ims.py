@@ -0,0 +1,164 @@
+from pathlib import Path
+# h5py is only needed for .ims inputs
+try:
+    from h5py import File
+except ImportError:
+    File = None
+from numpy import stack, repeat, diff, cumsum, zeros, asarray, float32, float64, int32, int64
+from tqdm import tqdm
+from utils import save_numpy, save_faces
+from utils import COORDS_SUBFOLDER, INDICES_SUBFOLDER, NORMALS_SUBFOLDER, VECTOR_FILE_ROWS, DEFS_PER_FILE
+
+
+# Surfaces are read from the Imaris scene stored in the .ims file:
+#   Scene8/Content/Surfaces<k>/Vertex        one row per vertex: x, y, z in physical units, optionally followed by the
+#                                            normal.  Compound rows use the fields PositionX/Y/Z and NormalX/Y/Z.
+#   Scene8/Content/Surfaces<k>/Triangle      one row of 3 vertex indices per triangle, relative to the first vertex of
+#                                            the triangle's surface
+#   Scene8/Content/Surfaces<k>/SurfaceModel  one compound row per surface with its ID and either the offsets of its
+#                                            first vertex and triangle (VertexOffset, TriangleOffset) or its vertex and
+#                                            triangle counts (VertexNumber, TriangleNumber).  Vertices and triangles of
+#                                            a surface are contiguous and stored in surface order.
+SURFACES_GROUP = "Scene8/Content/Surfaces{}"
+POSITION_FIELDS = ("PositionX", "PositionY", "PositionZ")
+NORMAL_FIELDS = ("NormalX", "NormalY", "NormalZ")
+
+
+# reads rows [start, stop) of an (N, 3) quantity from dataset.  Plain datasets are read from column first_column on,
+# compound ones from the given fields, or from their first three fields if none are given.
+def read_columns(dataset, start: int, stop: int, fields: tuple = (), first_column: int = 0):
+    block = dataset[start:stop]
+    if block.dtype.names:
+        return stack([block[field] for field in (fields or block.dtype.names[:3])], axis=1)
+    return block[:, first_column:first_column + 3]
+
+
+def has_normals(dataset):
+    if dataset.dtype.names:
+        return all(field in dataset.dtype.names for field in NORMAL_FIELDS)
+    return dataset.ndim == 2 and dataset.shape[1] >= 6
+
+
+# returns the surface names and the offsets of each surface's first vertex and triangle, each with a final entry
+# holding the totals, so surface i owns vertices vertex_offsets[i]:vertex_offsets[i + 1]
+def read_ims_layout(filepath: Path, surfaces: int = 0):
+    if File is None:
+        print("ERROR: h5py is not installed.  It is needed for .ims inputs (pip install h5py).")
+        return None
+    with File(filepath, 'r') as f:
+        group_name = SURFACES_GROUP.format(surfaces)
+        if group_name not in f:
+            print(f"ERROR: bad ims format - cannot find {group_name}.")
+            return None
+        group = f[group_name]
+        model = group["SurfaceModel"][:]
+        fields = model.dtype.names
+        n_vertices = len(group["Vertex"])
+        n_triangles = len(group["Triangle"])
+
+    if "VertexOffset" in fields and "TriangleOffset" in fields:
+        vertex_offsets = asarray(list(model["VertexOffset"]) + [n_vertices], dtype=int64)
+        triangle_offsets = asarray(list(model["TriangleOffset"]) + [n_triangles], dtype=int64)
+    elif "VertexNumber" in fields and "TriangleNumber" in fields:
+        vertex_offsets = zeros(len(model) + 1, dtype=int64)
+        triangle_offsets = zeros(len(model) + 1, dtype=int64)
+        cumsum(model["VertexNumber"], out=vertex_offsets[1:])
+        cumsum(model["TriangleNumber"], out=triangle_offsets[1:])
+    else:
+        print("ERROR: bad ims format - SurfaceModel has no vertex and triangle offsets or counts.")
+        return None
+
+    return {"surfaces": surfaces,
+            "def_names": asarray([f"_{surface_id}" for surface_id in model["ID"]]),
+            "vertex_offsets": vertex_offsets,
+            "triangle_offsets": triangle_offsets}
+
+
+# reads the triangles of surfaces [first, last) in one contiguous read, shifted to index the whole vertex array.
+# Returns the (F, 3) faces and the number of faces of each surface.
+def read_surface_triangles(triangles, layout: dict, first: int, last: int):
+    triangle_offsets = layout["triangle_offsets"]
+    counts = diff(triangle_offsets[first:last + 1])
+    faces = read_columns(triangles, int(triangle_offsets[first]), int(triangle_offsets[last])).astype(int64)
+    faces += repeat(layout["vertex_offsets"][first:last], counts)[:, None]
+    return faces, counts
+
+
+# ims counterpart of parse_wrl.read_wrl, writing the same np_coords, np_normals and np_indices folders.  Vertices are
+# read in chunks of VECTOR_FILE_ROWS rows and triangles in chunks of DEFS_PER_FILE surfaces.
+def read_ims(filepath: Path, output_path: Path, surfaces: int = 0, skip_to: int = 0, on_triangle_file=None):
+    layout = read_ims_layout(filepath, surfaces)
+    if layout is None:
+        return -1
+
+    with File(filepath, 'r') as f:
+        group = f[SURFACES_GROUP.format(surfaces)]
+        vertices = group["Vertex"]
+
+        coords_path = output_path / COORDS_SUBFOLDER
+        coords_path.mkdir(exist_ok=True)
+        if skip_to >= 1:
+            print("Skipping reading coordinates")
+        else:
+            print("Reading coordinates")
+            for file_count, start in enumerate(range(0, len(vertices), VECTOR_FILE_ROWS)):
+                coords = read_columns(vertices, start, start + VECTOR_FILE_ROWS, POSITION_FIELDS)
+                save_numpy(coords_path / f"coord_{file_count}.npy", coords.astype(float32))
+
+        normals_path = output_path / NORMALS_SUBFOLDER
+        normals_path.mkdir(exist_ok=True)
+        if skip_to >= 2:
+            print("Skipping reading normals")
+        elif not has_normals(vertices):
+            print("No normals stored, skipping reading normals")
+        else:
+            print("Reading normals")
+            for file_count, start in enumerate(range(0, len(vertices), VECTOR_FILE_ROWS)):
+                normals = read_columns(vertices, start, start + VECTOR_FILE_ROWS, NORMAL_FIELDS, 3)
+                save_numpy(normals_path / f"normal_{file_count}.npy", normals.astype(float64))
+
+        print("Reading triangles")
+        triangles_path = output_path / INDICES_SUBFOLDER
+        triangles_path.mkdir(exist_ok=True)
+        def_names = layout["def_names"]
+        triangle_index = {}
+        for file_count, first in enumerate(tqdm(range(0, len(def_names), DEFS_PER_FILE))):
+            last = min(first + DEFS_PER_FILE, len(def_names))
+            faces, counts = read_surface_triangles(group["Triangle"], layout, first, last)
+            name = f"indices_{file_count}"
+            save_faces(triangles_path / name, list(def_names[first:last]), faces, counts)
+            bounds = [int(faces.min()), int(faces.max())] if len(faces) else [9999999999, -1]
+            triangle_index[name] = bounds
+            if on_triangle_file is not None:
+                on_triangle_file(triangles_path / name, bounds)
+        save_numpy(triangles_path / "_index.npy", triangle_index)
+    return 0
+
+
+# streaming counterpart of read_ims: returns the physical coordinates held in memory and the surface layout, whose
+# meshes can then be read with iter_ims_meshes
+def stream_ims(filepath: Path, surfaces: int = 0):
+    layout = read_ims_layout(filepath, surfaces)
+    if layout is None:
+        return None
+
+    print("Reading coordinates")
+    with File(filepath, 'r') as f:
+        vertices = f[SURFACES_GROUP.format(surfaces)]["Vertex"]
+        coords = read_columns(vertices, 0, len(vertices), POSITION_FIELDS).astype(float32)
+    return coords, layout
+
+
+# yields (name, faces) for every surface, reading triangles DEFS_PER_FILE surfaces at a time
+def iter_ims_meshes(filepath: Path, layout: dict):
+    def_names = layout["def_names"]
+    with File(filepath, 'r') as f:
+        triangles = f[SURFACES_GROUP.format(layout["surfaces"])]["Triangle"]
+        for first in range(0, len(def_names), DEFS_PER_FILE):
+            last = min(first + DEFS_PER_FILE, len(def_names))
+            faces, counts = read_surface_triangles(triangles, layout, first, last)
+            faces = faces.astype(int32)
+            offsets = zeros(len(counts) + 1, dtype=int64)
+            cumsum(counts, out=offsets[1:])
+            for i in range(len(counts)):
+                yield str(def_names[first + i]), faces[offsets[i]:offsets[i + 1]]
@@ -0,0 +1,208 @@
+from numpy import ndarray, zeros, empty, unique, ceil, floor, sort, float64, int64, bool_
+from numba import jit
+
+
+# Solid voxelization straight from the triangles, without a surface voxel grid and binary_fill_holes.  Vertices are in
+# voxel units relative to the mesh's minimum corner, and voxel (i, j, k) is centred on the point (i, j, k), as in the
+# open3d voxel grid used by rasterize_mesh.  A voxel is filled if its centre is inside the mesh, found by casting one
+# ray along z per (x, y) column and filling between pairs of crossings, or if a triangle passes through it.
+
+# rays are cast through (x + RAY_OFFSET_X, y + RAY_OFFSET_Y) instead of through the voxel centres, so they never pass
+# exactly through the integer vertices or the edges between them
+RAY_OFFSET_X = 1.0e-4 * 2 ** 0.5
+RAY_OFFSET_Y = 1.0e-4 * 3 ** 0.5
+
+
+# returns the z at which the ray of column (x, y) crosses triangle f, or nan if it misses
+@jit(nopython=True, cache=True)
+def ray_crossing(vertices, faces, f, x, y):
+    a = vertices[faces[f, 0]]
+    b = vertices[faces[f, 1]]
+    c = vertices[faces[f, 2]]
+    area = (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+    if area == 0.0:
+        return float64(float('nan'))
+    wa = ((b[0] - x) * (c[1] - y) - (b[1] - y) * (c[0] - x)) / area
+    wb = ((c[0] - x) * (a[1] - y) - (c[1] - y) * (a[0] - x)) / area
+    wc = 1.0 - wa - wb
+    if wa < 0.0 or wb < 0.0 or wc < 0.0:
+        return float64(float('nan'))
+    return wa * a[2] + wb * b[2] + wc * c[2]
+
+
+# finds the crossings of every column ray with the triangles.  Without store only the number of crossings per column
+# is counted; with store each crossing is also written to crossings, starting at the column's offset.
+@jit(nopython=True, cache=True)
+def collect_crossings(vertices, faces, nx, ny, counts, offsets, crossings, store):
+    for f in range(len(faces)):
+        lo_x = min(vertices[faces[f, 0], 0], vertices[faces[f, 1], 0], vertices[faces[f, 2], 0])
+        hi_x = max(vertices[faces[f, 0], 0], vertices[faces[f, 1], 0], vertices[faces[f, 2], 0])
+        lo_y = min(vertices[faces[f, 0], 1], vertices[faces[f, 1], 1], vertices[faces[f, 2], 1])
+        hi_y = max(vertices[faces[f, 0], 1], vertices[faces[f, 1], 1], vertices[faces[f, 2], 1])
+        for i in range(max(int(ceil(lo_x - RAY_OFFSET_X)), 0), min(int(floor(hi_x - RAY_OFFSET_X)), nx - 1) + 1):
+            for j in range(max(int(ceil(lo_y - RAY_OFFSET_Y)), 0), min(int(floor(hi_y - RAY_OFFSET_Y)), ny - 1) + 1):
+                z = ray_crossing(vertices, faces, f, i + RAY_OFFSET_X, j + RAY_OFFSET_Y)
+                if z != z:
+                    continue
+                column = i * ny + j
+                if store:
+                    crossings[offsets[column] + counts[column]] = z
+                counts[column] += 1
+
+
+# fills the voxels whose centres lie between each pair of sorted crossings of their column.  An unpaired last
+# crossing, left by a mesh that is not closed, is ignored.
+@jit(nopython=True, cache=True)
+def fill_columns(offsets, crossings, image):
+    nx, ny, nz = image.shape
+    for column in range(nx * ny):
+        i = column // ny
+        j = column % ny
+        zs = sort(crossings[offsets[column]:offsets[column + 1]])
+        for k in range(0, len(zs) - 1, 2):
+            for z in range(max(int(ceil(zs[k])), 0), min(int(floor(zs[k + 1])), nz - 1) + 1):
+                image[i, j, z] = True
+
+
+# whether the projections of the triangle (x0, y0, z0), (x1, y1, z1), (x2, y2, z2) and of the unit voxel centred on
+# the origin onto axis (ax, ay, az) are separated
+@jit(nopython=True, cache=True)
+def separated(ax, ay, az, x0, y0, z0, x1, y1, z1, x2, y2, z2):
+    p0 = ax * x0 + ay * y0 + az * z0
+    p1 = ax * x1 + ay * y1 + az * z1
+    p2 = ax * x2 + ay * y2 + az * z2
+    r = 0.5 * (abs(ax) + abs(ay) + abs(az))
+    return min(p0, p1, p2) > r or max(p0, p1, p2) < -r
+
+
+# separating axis test between a triangle and the unit voxel centred on the origin, as used by open3d to voxelize
+# triangle meshes.  The candidate axes are x, y, z, the cross products of x, y and z with each edge, and the normal.
+@jit(nopython=True, cache=True)
+def triangle_overlaps_voxel(x0, y0, z0, x1, y1, z1, x2, y2, z2):
+    if (separated(1.0, 0.0, 0.0, x0, y0, z0, x1, y1, z1, x2, y2, z2)
+            or separated(0.0, 1.0, 0.0, x0, y0, z0, x1, y1, z1, x2, y2, z2)
+            or separated(0.0, 0.0, 1.0, x0, y0, z0, x1, y1, z1, x2, y2, z2)):
+        return False
+    edges = ((x1 - x0, y1 - y0, z1 - z0), (x2 - x1, y2 - y1, z2 - z1), (x0 - x2, y0 - y2, z0 - z2))
+    for ex, ey, ez in edges:
+        if (separated(0.0, -ez, ey, x0, y0, z0, x1, y1, z1, x2, y2, z2)
+                or separated(ez, 0.0, -ex, x0, y0, z0, x1, y1, z1, x2, y2, z2)
+                or separated(-ey, ex, 0.0, x0, y0, z0, x1, y1, z1, x2, y2, z2)):
+            return False
+    (ux, uy, uz), (vx, vy, vz) = edges[0], edges[1]
+    return not separated(uy * vz - uz * vy, uz * vx - ux * vz, ux * vy - uy * vx,
+                         x0, y0, z0, x1, y1, z1, x2, y2, z2)
+
+
+# marks every voxel a triangle passes through, giving the surface shell
+@jit(nopython=True, cache=True)
+def mark_surface(vertices, faces, image):
+    nx, ny, nz = image.shape
+    for f in range(len(faces)):
+        a = vertices[faces[f, 0]]
+        b = vertices[faces[f, 1]]
+        c = vertices[faces[f, 2]]
+        for i in range(max(int(ceil(min(a[0], b[0], c[0]) - 0.5)), 0),
+                       min(int(floor(max(a[0], b[0], c[0]) + 0.5)), nx - 1) + 1):
+            for j in range(max(int(ceil(min(a[1], b[1], c[1]) - 0.5)), 0),
+                           min(int(floor(max(a[1], b[1], c[1]) + 0.5)), ny - 1) + 1):
+                for k in range(max(int(ceil(min(a[2], b[2], c[2]) - 0.5)), 0),
+                               min(int(floor(max(a[2], b[2], c[2]) + 0.5)), nz - 1) + 1):
+                    if not image[i, j, k] and triangle_overlaps_voxel(a[0] - i, a[1] - j, a[2] - k,
+                                                                      b[0] - i, b[1] - j, b[2] - k,
+                                                                      c[0] - i, c[1] - j, c[2] - k):
+                        image[i, j, k] = True
+
+
+# native counterpart of the open3d engine of rasterize_mesh.rasterize_single_mesh.  indices index coordinates directly.
+# Returns the solid mask and the minimum and maximum corners of the mesh.
+def voxelize_solid(indices: ndarray, coordinates):
+    used, faces = unique(indices, return_inverse=True)
+    faces = faces.reshape(-1, 3)
+    vertices = coordinates[used].astype(float64)
+    mins = vertices.min(axis=0)
+    maxs = vertices.max(axis=0)
+    vertices -= mins
+
+    image = zeros(tuple([int(maxs[i] - mins[i] + 1) for i in range(len(mins))]), dtype=bool)
+    nx, ny = image.shape[0], image.shape[1]
+    counts = zeros(nx * ny, dtype=int64)
+    offsets = zeros(nx * ny + 1, dtype=int64)
+    collect_crossings(vertices, faces, nx, ny, counts, offsets, empty(0, dtype=float64), False)
+    offsets[1:] = counts.cumsum()
+    crossings = empty(offsets[-1], dtype=float64)
+    counts[:] = 0
+    collect_crossings(vertices, faces, nx, ny, counts, offsets, crossings, True)
+    fill_columns(offsets, crossings, image)
+    mark_surface(vertices, faces, image)
+    return image, mins, maxs
+
+
+# fills the background voxels of image that cannot reach its border through face-adjacent background voxels, as
+# scipy's binary_fill_holes does with its default structure.  With slicewise, each z-slice is filled on its own through
+# edge-adjacent pixels, as rasterize_mesh.fill_slices does.
+@jit(nopython=True, cache=True)
+def fill_enclosed(image, slicewise):
+    nx, ny, nz = image.shape
+    outside = zeros(image.shape, dtype=bool_)
+    stack = empty((nx * ny * nz, 3), dtype=int64)
+    top = 0
+    for i in range(nx):
+        for j in range(ny):
+            for k in range(nz):
+                border = i == 0 or i == nx - 1 or j == 0 or j == ny - 1 or (not slicewise and (k == 0 or k == nz - 1))
+                if border and not image[i, j, k]:
+                    outside[i, j, k] = True
+                    stack[top, 0], stack[top, 1], stack[top, 2] = i, j, k
+                    top += 1
+    while top > 0:
+        top -= 1
+        i, j, k = stack[top, 0], stack[top, 1], stack[top, 2]
+        for di, dj, dk in ((-1, 0, 0), (1, 0, 0), (0, -1, 0), (0, 1, 0), (0, 0, -1), (0, 0, 1)):
+            if slicewise and dk != 0:
+                continue
+            a, b, c = i + di, j + dj, k + dk
+            if 0 <= a < nx and 0 <= b < ny and 0 <= c < nz and not image[a, b, c] and not outside[a, b, c]:
+                outside[a, b, c] = True
+                stack[top, 0], stack[top, 1], stack[top, 2] = a, b, c
+                top += 1
+    for i in range(nx):
+        for j in range(ny):
+            for k in range(nz):
+                if not outside[i, j, k]:
+                    image[i, j, k] = True
+
+
+# solid masks of many small meshes in one call.  Mesh m is made of faces[face_offsets[m]:face_offsets[m + 1]], which
+# index vertices, and its mask, of shape shapes[m] with minimum corner mins[m], is written flattened to
+# masks[mask_offsets[m]:mask_offsets[m + 1]], which must be zeroed.  With native the mask is filled as by
+# voxelize_solid; otherwise the surface is filled as by binary_fill_holes or, with slicewise, by
+# rasterize_mesh.fill_slices, as the open3d engine does.
+@jit(nopython=True, cache=True)
+def voxelize_batch(vertices, faces, face_offsets, mins, shapes, mask_offsets, masks, native, slicewise):
+    for m in range(len(face_offsets) - 1):
+        # every face gets its own three vertices, relative to the mesh's minimum corner
+        n_faces = face_offsets[m + 1] - face_offsets[m]
+        local_vertices = empty((3 * n_faces, 3), dtype=float64)
+        local_faces = empty((n_faces, 3), dtype=int64)
+        for f in range(n_faces):
+            for c in range(3):
+                for a in range(3):
+                    local_vertices[3 * f + c, a] = vertices[faces[face_offsets[m] + f, c], a] - mins[m, a]
+                local_faces[f, c] = 3 * f + c
+
+        image = masks[mask_offsets[m]:mask_offsets[m + 1]].reshape((shapes[m, 0], shapes[m, 1], shapes[m, 2]))
+        if native:
+            nx, ny = shapes[m, 0], shapes[m, 1]
+            counts = zeros(nx * ny, dtype=int64)
+            offsets = zeros(nx * ny + 1, dtype=int64)
+            collect_crossings(local_vertices, local_faces, nx, ny, counts, offsets, empty(0, dtype=float64), False)
+            offsets[1:] = counts.cumsum()
+            crossings = empty(offsets[-1], dtype=float64)
+            counts[:] = 0
+            collect_crossings(local_vertices, local_faces, nx, ny, counts, offsets, crossings, True)
+            fill_columns(offsets, crossings, image)
+            mark_surface(local_vertices, local_faces, image)
+        else:
+            mark_surface(local_vertices, local_faces, image)
+            fill_enclosed(image, slicewise)
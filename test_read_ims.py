@@ -0,0 +1,110 @@
+from pathlib import Path
+from numpy import array, arange, concatenate, zeros, float32, float64, int64
+from pytest import importorskip, mark
+
+import read_ims
+from read_ims import read_ims_layout, stream_ims, iter_ims_meshes, SURFACES_GROUP
+from utils import load_faces, load_numpy, COORDS_SUBFOLDER, NORMALS_SUBFOLDER, INDICES_SUBFOLDER
+
+h5py = importorskip("h5py")
+
+
+# three surfaces with ids 0, 5 and 7, laid out as Imaris stores them: the vertices and triangles of each surface are
+# contiguous, and triangles index the vertices of their own surface
+SURFACE_IDS = [0, 5, 7]
+SURFACE_VERTICES = [
+    array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1]], dtype=float32),
+    array([[10, 10, 10], [11, 10, 10], [10, 11, 10]], dtype=float32),
+    array([[20, 20, 20], [21, 20, 20], [20, 21, 20], [21, 21, 20]], dtype=float32),
+]
+SURFACE_TRIANGLES = [
+    array([[0, 1, 2], [0, 1, 3], [0, 2, 3], [1, 2, 3]]),
+    array([[0, 1, 2]]),
+    array([[0, 1, 2], [1, 3, 2]]),
+]
+# triangles indexing the whole vertex array, as read_ims writes them
+EXPECTED_FACES = [triangles + sum(len(v) for v in SURFACE_VERTICES[:i])
+                  for i, triangles in enumerate(SURFACE_TRIANGLES)]
+VERTICES = concatenate(SURFACE_VERTICES)
+NORMALS = arange(len(VERTICES) * 3, dtype=float32).reshape(-1, 3) / 10
+
+
+# writes an .ims file holding the surfaces in Scene8/Content/Surfaces<surfaces>.  compound stores the vertices with
+# named Position and Normal fields and the surface model with offsets; otherwise vertices are rows of 6 values and the
+# surface model holds counts.
+def write_ims(filepath: Path, compound: bool, surfaces: int = 0):
+    n_vertices = [len(v) for v in SURFACE_VERTICES]
+    n_triangles = [len(t) for t in SURFACE_TRIANGLES]
+    with h5py.File(filepath, 'w') as f:
+        group = f.create_group(SURFACES_GROUP.format(surfaces))
+        if compound:
+            vertex = zeros(len(VERTICES), dtype=[(field, float32) for field in read_ims.POSITION_FIELDS
+                                                 + read_ims.NORMAL_FIELDS])
+            for i, field in enumerate(read_ims.POSITION_FIELDS):
+                vertex[field] = VERTICES[:, i]
+            for i, field in enumerate(read_ims.NORMAL_FIELDS):
+                vertex[field] = NORMALS[:, i]
+            model = zeros(len(SURFACE_IDS), dtype=[("ID", int64), ("VertexOffset", int64),
+                                                   ("TriangleOffset", int64)])
+            model["VertexOffset"] = concatenate([[0], n_vertices[:-1]]).cumsum()
+            model["TriangleOffset"] = concatenate([[0], n_triangles[:-1]]).cumsum()
+        else:
+            vertex = concatenate([VERTICES, NORMALS], axis=1)
+            model = zeros(len(SURFACE_IDS), dtype=[("ID", int64), ("VertexNumber", int64),
+                                                   ("TriangleNumber", int64)])
+            model["VertexNumber"] = n_vertices
+            model["TriangleNumber"] = n_triangles
+        model["ID"] = SURFACE_IDS
+        group.create_dataset("Vertex", data=vertex)
+        group.create_dataset("Triangle", data=concatenate(SURFACE_TRIANGLES).astype(int64))
+        group.create_dataset("SurfaceModel", data=model)
+
+
+@mark.parametrize("compound", [True, False])
+def test_read_ims_layout(tmp_path, compound):
+    write_ims(tmp_path / "surfaces.ims", compound, surfaces=2)
+    layout = read_ims_layout(tmp_path / "surfaces.ims", surfaces=2)
+    assert list(layout["def_names"]) == ["_0", "_5", "_7"]
+    assert list(layout["vertex_offsets"]) == [0, 4, 7, 11]
+    assert list(layout["triangle_offsets"]) == [0, 4, 5, 7]
+    assert read_ims_layout(tmp_path / "surfaces.ims", surfaces=0) is None
+
+
+@mark.parametrize("compound", [True, False])
+def test_read_ims(tmp_path, monkeypatch, compound):
+    # two surfaces per indices_N folder, so the surfaces are split over two folders
+    monkeypatch.setattr(read_ims, "DEFS_PER_FILE", 2)
+    write_ims(tmp_path / "surfaces.ims", compound)
+    for subfolder in (COORDS_SUBFOLDER, NORMALS_SUBFOLDER, INDICES_SUBFOLDER):
+        (tmp_path / subfolder).mkdir()
+    queued = []
+    assert read_ims.read_ims(tmp_path / "surfaces.ims", tmp_path,
+                             on_triangle_file=lambda path, bounds: queued.append((path.name, bounds))) == 0
+
+    coords = load_numpy(tmp_path / COORDS_SUBFOLDER / "coord_0.npy")
+    assert coords.dtype == float32 and (coords == VERTICES).all()
+    normals = load_numpy(tmp_path / NORMALS_SUBFOLDER / "normal_0.npy")
+    assert normals.dtype == float64 and (normals == NORMALS).all()
+
+    names, faces, offsets = load_faces(tmp_path / INDICES_SUBFOLDER / "indices_0")
+    assert list(names) == ["_0", "_5"]
+    assert (faces[offsets[0]:offsets[1]] == EXPECTED_FACES[0]).all()
+    assert (faces[offsets[1]:offsets[2]] == EXPECTED_FACES[1]).all()
+    names, faces, offsets = load_faces(tmp_path / INDICES_SUBFOLDER / "indices_1")
+    assert list(names) == ["_7"]
+    assert (faces == EXPECTED_FACES[2]).all()
+
+    index = load_numpy(tmp_path / INDICES_SUBFOLDER / "_index.npy", True)
+    assert index == {"indices_0": [0, 6], "indices_1": [7, 10]}
+    assert queued == list(index.items())
+
+
+def test_stream_ims(tmp_path, monkeypatch):
+    monkeypatch.setattr(read_ims, "DEFS_PER_FILE", 2)
+    write_ims(tmp_path / "surfaces.ims", compound=True)
+    coords, layout = stream_ims(tmp_path / "surfaces.ims")
+    assert (coords == VERTICES).all()
+    meshes = list(iter_ims_meshes(tmp_path / "surfaces.ims", layout))
+    assert [name for name, _ in meshes] == ["_0", "_5", "_7"]
+    for (_, faces), expected in zip(meshes, EXPECTED_FACES):
+        assert (faces == expected).all()
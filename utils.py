@@ -1,8 +1,54 @@
 from pathlib import Path
-from numpy import save, load, concatenate, asarray, min, max
+from numpy import save, savez, load, concatenate, asarray, min, max, int32, int64, cumsum, zeros, empty, ndarray, prod
+from numpy import dtype as dtype_of
+from numba import jit
+from multiprocessing.shared_memory import SharedMemory
+from multiprocessing.pool import ThreadPool
 from tqdm import tqdm
 
 
+COORDS_SUBFOLDER = "np_coords"
+INDICES_SUBFOLDER = "np_indices"
+NORMALS_SUBFOLDER = "np_normals"
+MESH_SUBFOLDER = "np_meshes"
+IMAGE_SUBFOLDER = "image"
+LABELS_SUBFOLDER = "labels"
+OBJECTS_FILE = "objects"
+
+VECTOR_FILE_ROWS = 1000000  # rows stored in each coord_N.npy / normal_N.npy file
+DEFS_PER_FILE = 1000  # meshes stored in each indices_N folder
+
+
+# splits a flat coordIndex array at each -1 into triangles.  Returns the (F, 3) faces, the min and max index they
+# reference, and the length of the first face that is not a triangle (0 if every face is a triangle).
+@jit(nopython=True, cache=True)
+def split_faces(flat):
+    faces = empty((len(flat) // 3 + 1, 3), dtype=int32)
+    count = 0
+    length = 0
+    overall_min = 9999999999
+    overall_max = -1
+    for num in flat:
+        if num == -1 and length > 0:
+            if length != 3:
+                return faces[:count], overall_min, overall_max, length
+            count += 1
+            length = 0
+        else:
+            if num < overall_min:
+                overall_min = num
+            if num > overall_max:
+                overall_max = num
+            if length < 3:
+                faces[count, length] = num
+            length += 1
+    if length > 0:
+        if length != 3:
+            return faces[:count], overall_min, overall_max, length
+        count += 1
+    return faces[:count], overall_min, overall_max, 0
+
+
 def read_index_file(filepath: Path):
     d = {}
     with filepath.open('r') as f:
@@ -13,17 +59,7 @@ def read_index_file(filepath: Path):
         for line in f:
             if line.strip()[0:3] == 'DEF':
                 if obj:
-                    arr = []
-                    temp = []
-                    for num in raw_arr:
-                        if num == -1 and temp:
-                            arr.append(temp)
-                            temp = []
-                        else:
-                            temp.append(num)
-                    if temp:
-                        arr.append(temp)
-                    d[obj] = arr
+                    d[obj] = read_index_faces(obj, raw_arr)
                 obj = line.strip().split(' ')[1]
                 raw_arr = []
             else:
@@ -39,20 +75,17 @@ def read_index_file(filepath: Path):
                 if max(temp) > overall_max:
                     overall_max = max(temp)
         if obj:
-            arr = []
-            temp = []
-            for num in raw_arr:
-                if num == -1 and temp:
-                    arr.append(temp)
-                    temp = []
-                else:
-                    temp.append(num)
-            if temp:
-                arr.append(temp)
-            d[obj] = arr
+            d[obj] = read_index_faces(obj, raw_arr)
     return d, overall_min, overall_max
 
 
+def read_index_faces(obj: str, raw_arr: list):
+    faces, _, _, bad_length = split_faces(asarray(raw_arr, dtype=int64))
+    if bad_length:
+        raise ValueError(f"{obj} has a face with {bad_length} vertices, only triangles are supported.")
+    return faces.tolist()
+
+
 def convert_output_indices_to_npy():
     input_files = Path(r'E:\Aidan\plaques_extracted\output_indices')
     output_files = Path(r'E:\Aidan\plaques_extracted\np_indices')
@@ -101,5 +134,97 @@ def save_numpy(filepath: Path, data):
     save(filepath, data)
 
 
+# calls fn on each of items, with threads threads at once, showing progress.  what names the work in error messages.
+# Returns -1 if the threads were interrupted or fn raised an error, with one thread as with many.
+def run_threaded(fn, items, threads: int = 1, progress: bool = True, what: str = "items"):
+    if threads == 1:
+        try:
+            for item in tqdm(items, disable=not progress):
+                fn(item)
+        except KeyboardInterrupt:
+            print("KeyboardInterrupt detected, stopping...")
+            return -1
+        except Exception as e:
+            print(f"Processing {what} encountered an error, stopping...")
+            print(e)
+            return -1
+        return 0
+    pool = ThreadPool(processes=threads)
+    try:
+        for _ in tqdm(pool.imap_unordered(fn, items), total=len(items), disable=not progress):
+            pass
+    except KeyboardInterrupt:
+        print("KeyboardInterrupt detected, terminating thread pool...")
+        pool.terminate()
+        pool.join()
+        return -1
+    except Exception as e:
+        print(f"Thread pool for {what} encountered an error, terminating...")
+        print(e)
+        pool.terminate()
+        pool.join()
+        return -1
+    else:
+        pool.close()
+        pool.join()
+    return 0
+
+
+# saves a dict of arrays to the .npz file filepath, written through a file object so numpy does not append a second
+# .npz suffix
+def save_npz(filepath: Path, arrays: dict):
+    with filepath.open('wb') as f:
+        savez(f, **arrays)
+
+
+# loads an .npz file written by save_npz as a dict of arrays
+def load_npz(filepath: Path):
+    with load(filepath) as f:
+        return {key: f[key] for key in f.files}
+
+
+# saves the triangles of many meshes in compressed sparse row form: all faces in one flat (F, 3) int32 array, the
+# faces of names[i] being faces[offsets[i]:offsets[i + 1]].
+def save_faces(folder: Path, names: list, faces: list, counts: list):
+    folder.mkdir(exist_ok=True, parents=True)
+    offsets = zeros(len(counts) + 1, dtype=int64)
+    cumsum(counts, out=offsets[1:])
+    save(folder / "names.npy", asarray(names, dtype=str))
+    save(folder / "faces.npy", asarray(faces, dtype=int32).reshape(-1, 3))
+    save(folder / "offsets.npy", offsets)
+
+
+# loads a folder written by save_faces.  faces is memory-mapped, so slicing it does not read or copy other meshes.
+def load_faces(folder: Path):
+    names = load(folder / "names.npy")
+    faces = load(folder / "faces.npy", mmap_mode='r')
+    offsets = load(folder / "offsets.npy")
+    return names, faces, offsets
+
+
+# creates an uninitialized array in a new block of shared memory.  Returns the block, which the caller must close() and
+# unlink() once the array is no longer used, the (name, shape, dtype) other processes pass to attach_shared_array, and
+# the array.
+def new_shared_array(shape: tuple, dtype):
+    dtype = dtype_of(dtype)
+    memory = SharedMemory(create=True, size=int(prod(shape)) * dtype.itemsize or 1)
+    return memory, (memory.name, tuple(shape), dtype.str), ndarray(shape, dtype=dtype, buffer=memory.buf)
+
+
+# copies array into a new block of shared memory.  Returns the block and spec as new_shared_array does.
+def share_array(array: ndarray):
+    memory, spec, shared = new_shared_array(array.shape, array.dtype)
+    shared[...] = array
+    return memory, spec
+
+
+# attaches to an array shared with share_array.  Returns the block, which must stay open while the array is used, and
+# a zero-copy view of the array.
+def attach_shared_array(spec: tuple):
+    name, shape, dtype = spec
+    memory = SharedMemory(name=name)
+    return memory, ndarray(shape, dtype=dtype, buffer=memory.buf)
+
+
 if __name__ == '__main__':
     pass
\ No newline at end of file
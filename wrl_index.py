@@ -0,0 +1,102 @@
+from pathlib import Path
+from mmap import mmap, ACCESS_READ
+from numpy import asarray, int64
+from utils import save_npz, load_npz
+
+
+WRL_INDEX_SUFFIX = ".index.npz"
+
+
+# path of the section index stored next to the .wrl file
+def wrl_index_path(filepath: Path):
+    return filepath.with_name(filepath.name + WRL_INDEX_SUFFIX)
+
+
+# finds the byte offsets of the Coordinate and Normal arrays and of every coordIndex array in a single pass over the
+# memory-mapped file.  Offsets point at the first byte after '[' and at the closing ']' of each array.
+def build_wrl_index(filepath: Path):
+    with open(filepath, 'rb') as infile, mmap(infile.fileno(), 0, access=ACCESS_READ) as mm:
+        # coordinates start on the line after "Coordinate"
+        pos = mm.find(b"Coordinate")
+        if pos == -1:
+            print("ERROR: bad wrl format - cannot find coordinates.")
+            return None
+        coords_start = mm.find(b"\n", pos) + 1
+        coords_end = mm.find(b"]", coords_start)
+        if coords_start == 0 or coords_end == -1:
+            print("ERROR: bad wrl format - cannot find end of coordinates.")
+            return None
+
+        # normals start on the line after the first '{' following the coordinates
+        pos = mm.find(b"{", mm.find(b"\n", coords_end) + 1)
+        if pos == -1:
+            print("ERROR: bad wrl format - cannot find normals.")
+            return None
+        normals_start = mm.find(b"\n", pos) + 1
+        normals_end = mm.find(b"]", normals_start)
+        if normals_start == 0 or normals_end == -1:
+            print("ERROR: bad wrl format - cannot find end of normals.")
+            return None
+
+        # each coordIndex array belongs to the last "DEF _N" line before it
+        def_names = []
+        def_starts = []
+        def_ends = []
+        cur_def = "_0"
+        pos = mm.find(b"\n", normals_end) + 1
+        while True:
+            index_pos = mm.find(b"coordIndex", pos)
+            if index_pos == -1:
+                break
+            def_pos = mm.rfind(b"DEF _", pos, index_pos)
+            if def_pos != -1:
+                line_start = mm.rfind(b"\n", 0, def_pos) + 1
+                line_end = mm.find(b"\n", def_pos)
+                cur_def = mm[line_start:line_end].decode('utf-8').strip().split(' ')[1]
+            start = mm.find(b"[", index_pos) + 1
+            end = mm.find(b"]", start)
+            if start == 0 or end == -1:
+                print("ERROR: bad wrl format - cannot find end of triangles.")
+                return None
+            def_names.append(cur_def)
+            def_starts.append(start)
+            def_ends.append(end)
+            pos = end + 1
+        if not def_names:
+            print("ERROR: bad wrl format - cannot find triangles.")
+            return None
+
+    stat = filepath.stat()
+    return {"size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "coords": asarray([coords_start, coords_end], dtype=int64),
+            "normals": asarray([normals_start, normals_end], dtype=int64),
+            "def_names": asarray(def_names),
+            "def_starts": asarray(def_starts, dtype=int64),
+            "def_ends": asarray(def_ends, dtype=int64)}
+
+
+def save_wrl_index(filepath: Path, wrl_index: dict):
+    save_npz(wrl_index_path(filepath), wrl_index)
+
+
+# loads the section index of a .wrl file, rebuilding it if it is missing or the file has changed since it was written
+def load_wrl_index(filepath: Path):
+    index_path = wrl_index_path(filepath)
+    stat = filepath.stat()
+    if index_path.exists():
+        wrl_index = load_npz(index_path)
+        if int(wrl_index["size"]) == stat.st_size and int(wrl_index["mtime"]) == stat.st_mtime_ns:
+            print(f"Using section index {index_path}")
+            return wrl_index
+        print("Section index is out of date.")
+
+    print("Indexing wrl sections")
+    wrl_index = build_wrl_index(filepath)
+    if wrl_index is None:
+        return None
+    try:
+        save_wrl_index(filepath, wrl_index)
+    except OSError as e:
+        print(f"WARNING: could not save section index next to the input file: {e}")
+    return wrl_index
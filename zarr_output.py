@@ -0,0 +1,87 @@
+from pathlib import Path
+from numpy import rot90
+from utils import run_threaded
+# zarr is only needed for --output_format zarr.  The store is written with the zarr 3 API.
+try:
+    import zarr
+    from numcodecs import Blosc
+    if int(zarr.__version__.split(".")[0]) < 3:
+        zarr = None
+except ImportError:
+    zarr = None
+
+
+# tif: one 2D .tif file per z-slice, as in earlier versions
+# zarr: a single chunked, compressed OME-Zarr store (OME-NGFF 0.4, zarr format 2) with axes z, y, x, oriented as the
+#       .tif slices.  Chunks holding no voxels of any mesh are not written.
+OUTPUT_FORMATS = ["tif", "zarr"]
+DEFAULT_CHUNKS = [64, 64, 64]
+ZARR_SUFFIX = ".ome.zarr"
+
+
+# path of the OME-Zarr store saved instead of the .tif folder output
+def zarr_path(output: Path):
+    return output.with_name(output.name + ZARR_SUFFIX)
+
+
+# view of data, an image with axes x, y, z, with axes z, y, x instead, and flipped and rotated as the slices of the
+# saved image
+def oriented(data, flips):
+    view = rot90(data[::-1 if flips[0] else 1, ::-1 if flips[1] else 1, :]).transpose(2, 0, 1)
+    return view[::-1] if flips[2] else view
+
+
+# returns -1 if zarr 3, needed for --output_format zarr, is not installed
+def check_zarr():
+    if zarr is None:
+        print("ERROR: zarr>=3 is not installed.  It is needed for --output_format zarr (pip install \"zarr>=3\").")
+        return -1
+    return 0
+
+
+# creates an OME-Zarr store at path for an image of shape (z, y, x), chunked as chunks and compressed with zstd.
+# voxel_sizes (dx, dy, dz) give its scale.  Returns None if zarr 3 is not installed.
+def create_ome_zarr(path: Path, shape, dtype, chunks, voxel_sizes):
+    if check_zarr() != 0:
+        return None
+    dx, dy, dz = voxel_sizes
+    root = zarr.open_group(str(path), mode="w", zarr_format=2)
+    root.attrs["multiscales"] = [{"version": "0.4",
+                                  "name": path.name[:-len(ZARR_SUFFIX)],
+                                  "axes": [{"name": "z", "type": "space"},
+                                           {"name": "y", "type": "space"},
+                                           {"name": "x", "type": "space"}],
+                                  "datasets": [{"path": "0",
+                                                "coordinateTransformations": [{"type": "scale",
+                                                                               "scale": [dz, dy, dx]}]}]}]
+    return root.create_array("0", shape=tuple(int(s) for s in shape), chunks=tuple(int(c) for c in chunks),
+                             dtype=dtype, fill_value=0,
+                             compressors=Blosc(cname="zstd", clevel=5, shuffle=Blosc.BITSHUFFLE))
+
+
+# writes data, as save_image would save its slices, into the OME-Zarr store at path made by create_ome_zarr.  The
+# region of data is split along the chunks of the store, and each part is written by one of threads threads, so no
+# chunk is written by two threads at once.  A slab that does not start or end on a chunk boundary shares its end
+# chunks with the slabs next to it, which are then read back and rewritten.
+def save_zarr(data, path: Path, flips, binary=False, z_offset=0, depth=None, progress=True, threads=1):
+    array = zarr.open_array(str(path / "0"), mode="r+")
+    if progress:
+        print("Saving image chunks...")
+    depth = data.shape[2] if depth is None else depth
+    view = oriented(data, flips)
+    start = depth - z_offset - data.shape[2] if flips[2] else z_offset
+    end = start + data.shape[2]
+    cz, cy, cx = array.chunks
+    blocks = [(z, y, x) for z in range(start - start % cz, end, cz)
+              for y in range(0, view.shape[1], cy) for x in range(0, view.shape[2], cx)]
+
+    def save(block):
+        z, y, x = block
+        z0 = max(z, start)
+        z1 = min(z + cz, end)
+        part = view[z0 - start:z1 - start, y:y + cy, x:x + cx]
+        if binary:
+            part = part > 0
+        array[z0:z1, y:y + cy, x:x + cx] = part.astype(array.dtype)
+
+    return run_threaded(save, blocks, threads, progress, "saving image chunks")